@@ -64,7 +64,7 @@ class ExploreDFA:
 
 class DFABot(AntsBot):
     def __init__(self, world):
-        self.world = world
+        AntsBot.__init__(self, world)
         self.dfa = ExploreDFA()
         self.ant_state = {}
     
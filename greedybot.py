@@ -11,34 +11,27 @@ from src.antsbot import AntsBot
 from src.worldstate import AIM, AntStatus, AntWorld
 
 class GreedyBot(AntsBot):
-    def get_direction(self, ant):
-        '''Finds a direction for this ant to move in according to the food, enemy, exploration routine.'''
+    def get_directions(self, ant):
+        '''Ranks directions for this ant to move in according to the food, enemy, exploration routine.'''
         
         # Get the list of directions towards food, enemy, and random
-        rand_dirs = AIM.keys()
+        rand_dirs = [d for d in AIM.keys() if d != 'halt']
         random.shuffle(rand_dirs)
         dirs = (ant.toward(ant.closest_food()) + ant.toward(ant.closest_enemy()) + rand_dirs)
         
-        # Get the first passable direction from that long list.
-        d = ant.get_passable_direction(dirs)
-        return d
+        # Keep the passable directions from that long list, in order.
+        ranked = []
+        for d in self.world.get_enterable_directions(ant.location, dirs):
+            if d not in ranked:
+                ranked.append(d)
+        return ranked
 
     # Main logic
     def do_turn(self):
-        # Run the routine for each living ant independently.
-        next_locations = {}
-        for ant in self.world.ants:
-            if ant.status == AntStatus.ALIVE:
-                ant.direction = self.get_direction(ant)
-                
-                if ant.direction == 'halt' or ant.direction == None:
-                    ant.direction = None
-                else:
-                    # Basic collision detection: don't land on the same square as another friendly ant.
-                    nextpos = self.world.next_position(ant.location, ant.direction) 
-                    if nextpos in next_locations.keys():  
-                        ant.direction = None
-                    else:
-                        next_locations[nextpos] = ant.ant_id
+        # Rank directions for each living ant independently, then let the world
+        # resolve them into collision-free moves.
+        preferences = [(ant, self.get_directions(ant)) for ant in self.world.ants
+                       if ant.status == AntStatus.ALIVE]
+        self.world.resolve_moves(preferences)
         
 BOT = GreedyBot
@@ -5,15 +5,38 @@
 # A base class for Ant bots that are compatible with the
 # LocalEngine. They also automatically keep the AntWorld state updated
 # based on messages from the server/engine.
+#
+# AntsBot also keeps track of the turn deadline. Bots with expensive
+# per-ant logic can call checkpoint() inside their loops; once the
+# turn time is nearly used up, checkpoint() aborts do_turn() and the
+# orders last recorded with commit_orders() are sent instead, so that
+# the bot degrades gracefully rather than timing out. Bots that never
+# commit orders fall back to every ant staying put. (ValueBot catches
+# the deadline itself, and assigns moves to the ants it has evaluated
+# so far.)
 
 import sys
+import time
 import traceback
 
 from worldstate import Ant, AntStatus, AntWorld
 
+class TurnDeadline(Exception):
+    '''Raised by AntsBot.checkpoint() when the turn time is nearly used up.'''
+    pass
+
 class AntsBot(object):
+    # Stop computing when fewer than this many milliseconds remain in the turn.
+    deadline_margin = 100
+
+    # Time at which the current turn started.
+    turn_start = None
+
     def __init__(self, world):
         self.world = world
+        
+        # Known-good orders for the current turn (see commit_orders()).
+        self.good_orders = {}
 
     def do_turn(self):
         '''Template for logic that must be filled in by the child bot.'''
@@ -22,6 +45,49 @@ class AntsBot(object):
     def reset(self):
         pass    
 
+    def time_elapsed(self):
+        '''Milliseconds elapsed since the current turn started.'''
+        if self.turn_start is None:
+            return 0
+        return (time.time() - self.turn_start) * 1000.0
+
+    def time_remaining(self):
+        '''Milliseconds remaining before the turn deadline.'''
+        return self.world.turntime - self.time_elapsed()
+
+    def out_of_time(self, margin=None):
+        '''True if fewer than margin (default: deadline_margin) milliseconds remain in the turn.'''
+        if margin is None:
+            margin = self.deadline_margin
+        return self.time_remaining() < margin
+
+    def checkpoint(self):
+        '''Abort do_turn() if the turn is nearly out of time. Orders recorded with commit_orders() will be sent instead.'''
+        if self.out_of_time():
+            raise TurnDeadline("%.1f ms remaining" % self.time_remaining())
+
+    def commit_orders(self, ants=None):
+        '''Record the current directions of the given ants (default: all ants) as known-good orders for this turn.'''
+        if ants is None:
+            ants = self.world.ants
+        for ant in ants:
+            self.good_orders[ant] = ant.direction
+
+    def _begin_turn(self):
+        '''Start the turn clock. Until orders are committed, the fallback is for every ant to stay put.'''
+        self.turn_start = time.time()
+        self.good_orders = {}
+
+    def _do_turn(self):
+        '''Run do_turn(), falling back to the known-good orders if it runs out of time.'''
+        try:
+            self.do_turn()
+        except TurnDeadline as e:
+            self.world.L.warning("Turn deadline reached (%s), sending %d committed orders" %
+                                 (str(e), len(self.good_orders)))
+            for ant in self.world.ants:
+                ant.direction = self.good_orders.get(ant)
+
     def _receive(self, msg):
         '''Parses message from the server/engine and returns output.'''
         lines = msg.splitlines()
@@ -30,8 +96,9 @@ class AntsBot(object):
             return self.world._finish_turn()
 
         elif lines[-1].lower() == 'go':
+            self._begin_turn()
             self.world._update('\n'.join(lines[:-1]))
-            self.do_turn()
+            self._do_turn()
             return self.world._finish_turn()
         
         return ""
@@ -51,8 +118,9 @@ class AntsBot(object):
                     
                 elif current_line.lower() == 'go':
                     
+                    self._begin_turn()
                     self.world._update(map_data)
-                    self.do_turn()
+                    self._do_turn()
                     self.world._finish_turn()
                     map_data = ''
                 else:
@@ -62,4 +130,3 @@ class AntsBot(object):
             except Exception as e:
                 traceback.print_exc(file=sys.stderr)
                 break
-                    
\ No newline at end of file
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# An auction algorithm for assignment problems, used to pick
+# collision-free moves for all ants at once.
+#
+# Each person (ant) has a short list of options, each of which is an
+# object (a destination square) and the benefit of getting it. Persons
+# bid for the object with the best benefit net of its current price,
+# raising the price by the margin over their second-best option plus a
+# bidding increment epsilon, and outbid persons bid again. The result
+# maximizes the total benefit to within len(options) * epsilon.
+#
+# Since most ants don't compete for squares with any other ant, almost
+# every person bids only once or twice, and all prices start at zero,
+# which keeps the result optimal even though there are more squares
+# than ants. But when several ants want the same few squares and their
+# values are tied (e.g. a crowd at the mouth of a corridor), prices can
+# only rise by epsilon per bid, and a small epsilon makes for a long
+# "price war". So once the auction has taken more than BIDS_PER_PERSON
+# bids per person, it starts over with epsilon scaling: a first round
+# with a coarse increment quickly brings prices close to their final
+# values, and each following round starts from those prices with a
+# smaller increment, down to the requested one.
+#
+# An auction that starts from nonzero prices can leave squares that
+# nobody took with prices that are too high, so that ants that would be
+# better off with them settle for something else. Every round of
+# epsilon scaling is therefore followed by reverse auction steps
+# (Bertsekas' forward/reverse auction for asymmetric assignment), in
+# which such squares lower their prices to attract an ant, until no
+# square that nobody took is priced above the cheapest square that was
+# taken.
+
+from collections import deque
+
+# Bids per person after which the auction switches to epsilon scaling.
+BIDS_PER_PERSON = 10
+
+# Factor by which epsilon shrinks from one round of the auction to the next.
+EPSILON_FACTOR = 8.0
+
+def auction_assignment(options, epsilon=None):
+    '''Assign each person a distinct object, maximizing the total benefit.
+
+    options[i] is a list of (object, benefit) pairs for person i. Objects can be any
+    hashable values. Bids break ties in favor of the option listed first.
+
+    epsilon is the final bidding increment; by default it is small enough that the total
+    benefit is within 0.1% of the spread of the benefits of the optimum.
+
+    Returns a list with the index into options[i] of the option chosen by each person,
+    or None for persons that have no options. A feasible assignment must exist.
+    '''
+    n = len(options)
+    benefits = [b for person in options for obj, b in person]
+    if not benefits:
+        return [None] * n
+
+    spread = max(benefits) - min(benefits)
+    if spread <= 0:
+        spread = 1.0
+    if epsilon is None:
+        epsilon = 1e-3 * spread / (n + 1)
+
+    # Starting from zero prices, a single round is optimal without any reverse steps.
+    (choice, owner) = _forward_auction(options, {}, epsilon, spread, BIDS_PER_PERSON * n)
+    if choice is not None:
+        return choice
+
+    # The persons that can take each object, with their benefits.
+    bidders = {}
+    for i, person in enumerate(options):
+        for obj, benefit in person:
+            bidders.setdefault(obj, []).append((i, benefit))
+
+    prices = {}
+    step = max(epsilon, spread / EPSILON_FACTOR)
+    while True:
+        (choice, owner) = _forward_auction(options, prices, step, spread)
+        _reverse_auction(options, bidders, prices, choice, owner, step)
+        if step <= epsilon:
+            return choice
+        step = max(epsilon, step / EPSILON_FACTOR)
+
+def _forward_auction(options, prices, epsilon, spread, max_bids=None):
+    '''Assign every person by bidding, starting from (and updating) the given prices.
+
+    Returns (choice, owner): the option chosen by each person, and the person that owns
+    each object that was taken; or (None, None) if that takes more than max_bids bids.'''
+    n = len(options)
+    bids = 0
+
+    # A person with a single option outbids everyone else by more than any
+    # benefit difference.
+    lone_margin = spread + 1.0
+
+    owner = {}
+    choice = [None] * n
+    queue = deque(i for i in range(n) if options[i])
+    while queue:
+        bids += 1
+        if max_bids is not None and bids > max_bids:
+            return (None, None)
+        i = queue.popleft()
+        best = None
+        best_net = second_net = float('-inf')
+        for k, (obj, benefit) in enumerate(options[i]):
+            net = benefit - prices.get(obj, 0.0)
+            if net > best_net:
+                best, best_net, second_net = k, net, best_net
+            elif net > second_net:
+                second_net = net
+        if second_net == float('-inf'):
+            second_net = best_net - lone_margin
+
+        obj = options[i][best][0]
+        prices[obj] = prices.get(obj, 0.0) + best_net - second_net + epsilon
+        outbid = owner.get(obj)
+        owner[obj] = i
+        choice[i] = best
+        if outbid is not None:
+            choice[outbid] = None
+            queue.append(outbid)
+
+    return (choice, owner)
+
+def _reverse_auction(options, bidders, prices, choice, owner, epsilon):
+    '''Lower the prices of the objects nobody took to the price of the cheapest object that
+    was taken, reassigning persons to them where that pays off. bidders maps each object to
+    the (person, benefit) pairs of the persons that can take it. Updates choice and owner.'''
+    if not owner:
+        return
+    floor = min(prices[obj] for obj in owner)
+
+    queue = deque(obj for obj in bidders if obj not in owner and prices.get(obj, 0.0) > floor)
+    while queue:
+        obj = queue.popleft()
+
+        # Find the person that gains the most from this object at no price, relative to
+        # what it has now, and the second most.
+        best = None
+        best_gain = second_gain = float('-inf')
+        for i, benefit in bidders[obj]:
+            own_obj, own_benefit = options[i][choice[i]]
+            gain = benefit - (own_benefit - prices[own_obj])
+            if gain > best_gain:
+                best, best_gain, second_gain = i, gain, best_gain
+            elif gain > second_gain:
+                second_gain = gain
+
+        if floor >= best_gain - epsilon:
+            prices[obj] = floor
+            continue
+
+        # Price the object low enough to win over the best person, but no lower than
+        # needed to stay out of reach of the second best.
+        delta = min(best_gain - floor, best_gain - second_gain + epsilon)
+        prices[obj] = best_gain - delta
+        old_obj = options[best][choice[best]][0]
+        del owner[old_obj]
+        owner[obj] = best
+        choice[best] = [k for k, (o, b) in enumerate(options[best]) if o == obj][0]
+        if prices[old_obj] > floor:
+            queue.append(old_obj)
+
+if __name__ == '__main__':
+    # Check the auction against brute force on small random problems, and time it on
+    # congested ones: ants packed among water, with tied values for all their moves.
+    import itertools
+    import random
+    import time
+
+    def total(options, choice):
+        return sum(options[i][k][1] for i, k in enumerate(choice) if k is not None)
+
+    def brute_force(options):
+        best = float('-inf')
+        for choice in itertools.product(*[range(len(person)) for person in options]):
+            objs = [options[i][k][0] for i, k in enumerate(choice)]
+            if len(set(objs)) == len(objs):
+                best = max(best, total(options, choice))
+        return best
+
+    def random_problem(rng, size, water, num_ants, levels):
+        '''Ants on a size x size wrap-around map, who can stay put at a low value or move
+        to a neighbouring land square for one of the given values.'''
+        land = set((r, c) for r in range(size) for c in range(size) if rng.random() > water)
+        ants = rng.sample(sorted(land), min(num_ants, len(land)))
+        moves = []
+        for (r, c) in ants:
+            moves.append([(n_loc, float(rng.choice(levels))) for n_loc in
+                          (((r-1) % size, c), (r, (c+1) % size), ((r+1) % size, c), (r, (c-1) % size))
+                          if n_loc in land])
+        values = [v for person in moves for loc, v in person] or [0.0]
+        stay_value = min(values) - (max(values) - min(values)) - 1.0
+        options = []
+        for loc, person in zip(ants, moves):
+            person = [(loc, stay_value)] + person
+            rng.shuffle(person)
+            options.append(person)
+        return options
+
+    # Small problems hardly ever need epsilon scaling, so check them with it forced too.
+    rng = random.Random(0)
+    default_bids = BIDS_PER_PERSON
+    for bids_per_person in (default_bids, 0):
+        BIDS_PER_PERSON = bids_per_person
+        worst_error = 0.0
+        for trial in range(500):
+            options = random_problem(rng, 4, 0.3, rng.randint(1, 6), [0, 1, 2, 3])
+            choice = auction_assignment(options)
+            objs = [options[i][k][0] for i, k in enumerate(choice)]
+            assert len(set(objs)) == len(objs)
+            worst_error = max(worst_error, brute_force(options) - total(options, choice))
+        print "500 small problems, %d bids per person before scaling: largest shortfall from the optimum %.6f" % \
+            (bids_per_person, worst_error)
+    BIDS_PER_PERSON = default_bids
+
+    for num_ants in (100, 300, 900):
+        worst = 0.0
+        for trial in range(20):
+            options = random_problem(rng, int((num_ants * 3) ** 0.5), 0.5, num_ants, [0, 1])
+            start = time.time()
+            auction_assignment(options)
+            worst = max(worst, time.time() - start)
+        print "%d congested ants: worst of 20 in %.1f ms" % (num_ants, worst * 1000)
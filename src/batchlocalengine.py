@@ -13,6 +13,9 @@ from antsgame import *
 from logutil import *
 from copy import deepcopy
 from mapgen import SymmetricMap
+from results import bot_id
+from sequential import SequentialTest
+import random
 import time
 
 # Whether or not to crash the entire game upon invalid moves
@@ -25,8 +28,43 @@ STRICT_MODE = True
 class StepAnts(Ants):
     def __init__(self, options=None):
         Ants.__init__(self, options)
+        self.options = options
+
+        # Games end early once one bot (or uncollected food) makes up cutoff_percent 
+        # of all ants and food for cutoff_turn turns in a row, as in aic-sim/ants.py.
+        self.cutoff_percent = options.get('cutoff_percent', 0.90)
+        self.cutoff_turn = options.get('cutoff_turn', 100)
+        self.cutoff_bot = LAND # Can be ant owner, FOOD or LAND
+        self.cutoff_turns = 0
       
-    def Reset(self, map_text): 
+    def PickFoodParameters(self): # Content copied from Ants.__init__()
+        # Food parameters given as ranges are drawn at random.
+        for name, default in (('food_rate', (2,8)), ('food_turn', (12,30)), 
+                              ('food_start', (75,175)), ('food_visible', (1,3))):
+            value = self.options.get(name, default)
+            if type(value) in (list, tuple):
+                value = randrange(*value)
+            setattr(self, name, value)
+        
+    def Reset(self, map_text, engine_seed=None): 
+        # Reseed the engine so that games with the same seed play out the same way,
+        # including the food parameters that Ants.__init__() drew at random.
+        if engine_seed is not None:
+            self.engine_seed = engine_seed
+            seed(engine_seed)
+            self.PickFoodParameters()
+
+        # used to cutoff games early
+        self.cutoff_bot = LAND
+        self.cutoff_turns = 0
+
+        # Food spawning state is created on demand for the current map, so throw
+        # away what was left over from the previous game.
+        self.food_extra = Fraction(0,1)
+        for name in ('food_sets', 'food_sets_visible', 'pending_food'):
+            if hasattr(self, name):
+                delattr(self, name)
+
         map_data = self.parse_map(map_text)
 
         self.turn = 0
@@ -121,6 +159,35 @@ class StepAnts(Ants):
         # Since all the ants have moved we can update the vision.
         self.update_vision()
         self.update_revealed()
+        
+        self.UpdateCutoff()
+
+    def UpdateCutoff(self): # Content copied from aic-sim/ants.py finish_turn()
+        # calculate population counts for stopping games early
+        # FOOD can end the game as well, since no one is gathering it
+        pop_count = defaultdict(int)
+        for ant in self.current_ants.values():
+            pop_count[ant.owner] += 1
+        pop_count[FOOD] = len(self.current_food)
+        pop_total = sum(pop_count.values())
+        for owner, count in pop_count.items():
+            # Only a bot has to be winning on score too.
+            if (count >= pop_total * self.cutoff_percent
+                    and (owner == FOOD or self.score[owner] == max(self.score))):
+                if self.cutoff_bot == owner:
+                    self.cutoff_turns += 1
+                else:
+                    self.cutoff_bot = owner
+                    self.cutoff_turns = 1
+                break
+        else:
+            self.cutoff_bot = LAND
+            self.cutoff_turns = 0
+
+    def game_over(self):
+        if self.cutoff_turns >= self.cutoff_turn:
+            return True
+        return Ants.game_over(self)
                 
 class FakeLogger:
     def debug(self, text):
@@ -137,6 +204,12 @@ class FakeLogger:
         None
         # do nothing
         
+def GameSeeds(seed, num_games):
+    """ List of (map seed, engine seed) pairs for num_games games, generated from a single seed."""
+    
+    rng = random.Random(seed)
+    return [(rng.getrandbits(31), rng.getrandbits(31)) for i in range(num_games)]
+        
 # The actual local engine class. See top of file for description.
 class BatchLocalEngine:
     def __init__(self, game=None, level=logging.CRITICAL):
@@ -149,12 +222,33 @@ class BatchLocalEngine:
         self.map_list = []
         self.game = None
         
-    def RunTournament(self, num_games, team_a_bots, team_b_bots, map_dims):
+    def RunTournament(self, num_games, team_a_bots, team_b_bots, map_dims, seed=None, verbose=True,
+                      confidence=None, max_games=None, results=None, map_pool=None):
         """ Play a multi-game tournament between two teams of bots.
         
         For each bot in the lists team_a_bots and team_b_bots, plays num_games on random maps with
         sizes randomly generated between map_dims[0] and map_dims[1].
         
+        If seed is given, the maps and the engine's random numbers are generated from it (see 
+        GameSeeds()), so that tournaments with the same seed play every matchup on the same maps 
+        with the same food spawns, even when they run in different processes. Progress and 
+        timing are printed only if verbose is True.
+        
+        If confidence is given, each matchup is stopped as soon as a sequential test (see 
+        sequential.py) finds a clear winner, and the games saved are spent on the undecided 
+        matchups, up to max_games (default 3*num_games) each. The total number of games never 
+        exceeds that of a full tournament. bot_games then differs between bots, so compare them 
+        by rates rather than totals.
+        
+        If results (a ResultStore, see results.py) is given together with a seed, every game played
+        is appended to it, which makes the tournament resumable: games that are already in the
+        store are not played again, and their stored results are counted instead. Without a seed,
+        games can't be played again the same way, so they are neither recorded nor resumed.
+        
+        If map_pool (a MapPool, see mappool.py) is given, maps are drawn from it instead of being
+        generated for every game. With a seed, the draw starts at a position given by the seed,
+        otherwise where the previous tournament's draw stopped.
+        
         Returns a 4-tuple:
         (bot_scores,       - The score of each bot on each its games
          bot_wins,         - Whether or not each bot won for each of its games
@@ -175,65 +269,143 @@ class BatchLocalEngine:
         bot_score_diffs = deepcopy(bot_wins)
         bot_games = deepcopy(bot_wins)
         
+        num_maps = num_games
+        test = None
+        if confidence is not None:
+            num_maps = max_games or 3*num_games
+            test = SequentialTest(len(team_a_bots), len(team_b_bots), confidence, max_games=num_maps)
+        budget = num_games * len(team_a_bots) * len(team_b_bots)
+        
+        if seed is None:
+            seeds = [(None, None)] * num_maps
+        else:
+            seeds = GameSeeds(seed, num_maps)
+        map_texts = [None] * num_maps
+        if map_pool is not None:
+            start = None
+            if seed is not None:
+                start = seed
+            pool_maps = map_pool.maps(map_dims, num_maps, start)
+            seeds = [(pool_maps[i]['seed'], seeds[i][1]) for i in range(num_maps)]
+            map_texts = [m['text'] for m in pool_maps]
+        
+        if results is not None:
+            bot_ids = [[bot_id(bot) for bot in team_a_bots], [bot_id(bot) for bot in team_b_bots]]
+            cutoff = (self.game.cutoff_turn, self.game.cutoff_percent)
+        
         total_turns = 0
-        for i in range(0, num_games):
-            random_map = SymmetricMap(min_dim=map_dims[0], max_dim=map_dims[1])
-            random_map.random_walk_map()
+        resumed_games = 0
+        for i in range(0, num_maps):
+            map_seed, engine_seed = seeds[i]
+            map_text = map_texts[i]
+            # Maps from a pool have a seed even if the tournament has none, but the game only
+            # plays out the same way again with an engine seed.
+            replayable = results is not None and map_seed is not None and engine_seed is not None
 
             # Play all possible matchups between team A and team B
             
             status_string = "[map %d] " % i
-            if i > 0:
+            if played_games > 0:
+                # Estimate from the games left: under a sequential test, only active matchups
+                # still play, and they stop early, so this is an upper bound.
+                if test is None:
+                    remaining_games = (num_maps-i) * len(team_a_bots) * len(team_b_bots)
+                else:
+                    remaining_games = min(test.remaining_games(), budget - played_games)
                 elapsed = time.time() - start_time
-                avg_time = elapsed/i
-                remaining = (num_games-i)*avg_time
+                remaining = remaining_games * elapsed/played_games
                 
                 remaining_str = time.strftime("%H:%M:%S", time.gmtime(remaining))
                 status_string += "%s remaining " % remaining_str
             else:
                 status_string += "??:??:?? remaining "
-            sys.stdout.write(status_string)
-            sys.stdout.flush()
+            if verbose:
+                sys.stdout.write(status_string)
+                sys.stdout.flush()
             
             for a in range(0, len(team_a_bots)):
                 for b in range(0, len(team_b_bots)): 
-            
-                    # Run the bots against each other 
-                    self.game.Reset(random_map.map_text())
-                    self.bots = [(0, team_a_bots[a]), (1, team_b_bots[b])]
-                    for botnum, bot in self.bots:
-                        bot.world = self.GetWorld()
-                        bot.reset()
-                        bot.world.L = FakeLogger()
-                    self.Run()
+                    if test is not None and (not test.is_active(a, b) or played_games >= budget):
+                        continue
+                    
+                    # Reuse the result of a game played by an earlier run, if there is one
+                    record = None
+                    if replayable:
+                        key = results.key(map_seed, engine_seed, map_dims, self.game.turns, cutoff, 
+                                          bot_ids[0][a], bot_ids[1][b])
+                        record = results.get(key)
+                    
+                    if record is not None:
+                        scores = results.scores(record)
+                        turns = record['turns']
+                        resumed_games += 1
+                        progress = "+"
+                    else:
+                        if map_text is None:
+                            random_map = SymmetricMap(min_dim=map_dims[0], max_dim=map_dims[1], seed=map_seed)
+                            random_map.random_walk_map()
+                            map_text = random_map.map_text()
+                        
+                        # Run the bots against each other 
+                        game_start = time.time()
+                        bot_time = dict(self.bot_time)
+                        self.game.Reset(map_text, engine_seed)
+                        self.bots = [(0, team_a_bots[a]), (1, team_b_bots[b])]
+                        for botnum, bot in self.bots:
+                            bot.world = self.GetWorld()
+                            bot.reset()
+                            bot.world.L = FakeLogger()
+                        self.Run()
+                        scores = self.game.score
+                        turns = self.game.turn
+                        progress = "."
+                        
+                        if replayable:
+                            bot_time = dict((name, t - bot_time.get(name, 0)) for name, t in self.bot_time.items())
+                            results.add(map_seed, engine_seed, map_dims, self.game.turns, cutoff, 
+                                        (bot_ids[0][a], bot_ids[1][b]), scores, turns, 
+                                        time.time() - game_start, bot_time)
                     
                     # Record the scores
-                    if self.game.score[0] > self.game.score[1]:
+                    if scores[0] > scores[1]:
                         bot_wins[0][a] += 1
                     else:
                         bot_wins[1][b] +=1
-                    bot_scores[0][a] += self.game.score[0]
-                    bot_scores[1][b] += self.game.score[1]
+                    bot_scores[0][a] += scores[0]
+                    bot_scores[1][b] += scores[1]
         
-                    bot_score_diffs[0][a] += self.game.score[0]-self.game.score[1]
-                    bot_score_diffs[1][b] += self.game.score[1]-self.game.score[0]
+                    bot_score_diffs[0][a] += scores[0]-scores[1]
+                    bot_score_diffs[1][b] += scores[1]-scores[0]
                     
                     bot_games[0][a] += 1
                     bot_games[1][b] += 1
                     played_games += 1
-                    total_turns += self.game.turn
-                    sys.stdout.write(".")
-                    sys.stdout.flush()
+                    if test is not None:
+                        test.record(a, b, scores[0] > scores[1])
+                    total_turns += turns
+                    if verbose:
+                        sys.stdout.write(progress)
+                        sys.stdout.flush()
             
-            a_win_rate = max([float(bot_wins[0][j]) / float(bot_games[0][j]) for j in range(0, len(team_a_bots))]) 
-            b_win_rate = max([float(bot_wins[1][j]) / float(bot_games[1][j]) for j in range(0, len(team_b_bots))])
-            sys.stdout.write(" max A rate: %.2f, max B rate: %.2f\n" % (a_win_rate, b_win_rate))
+            if verbose:
+                a_win_rate = max([float(bot_wins[0][j]) / max(1, bot_games[0][j]) for j in range(0, len(team_a_bots))]) 
+                b_win_rate = max([float(bot_wins[1][j]) / max(1, bot_games[1][j]) for j in range(0, len(team_b_bots))])
+                sys.stdout.write(" max A rate: %.2f, max B rate: %.2f\n" % (a_win_rate, b_win_rate))
+            if test is not None and (test.done() or played_games >= budget):
+                break
             #print elapsed, " - map", i, ": team A bot_scores", str([float(s) for s in bot_scores[0]])
             #print elapsed, " - map", i, ": team B bot_scores", str([float(s) for s in bot_scores[1]])                                                        
         
         elapsed = time.time() - start_time        
+        if not verbose:
+            return (bot_scores, bot_wins, bot_score_diffs, bot_games)
+        
         sum_bots = 0
         print "Time summary: %.2f s total = %.2f s/game (%.2f turns/game) " % (elapsed, elapsed/played_games, total_turns/played_games)
+        if test is not None:
+            print "\tplayed %d of %d games" % (played_games, budget)
+        if results is not None:
+            print "\t%d games resumed from %s" % (resumed_games, results.filename)
         for b in self.bot_time.keys():
             sum_bots += self.bot_time[b]
             print "\tbot %s: %.5f s = %.2f%%" % (b, self.bot_time[b], self.bot_time[b]/elapsed*100)     
@@ -449,6 +621,14 @@ class BatchLocalEngine:
         parser.add_option("--attackradius2", dest="attackradius2",
                                             default=5, type="int",
                                             help="Attack radius of ants squared")
+        
+        # rules for ending lopsided games early
+        parser.add_option("--cutoff_turn", dest="cutoff_turn",
+                                            default=100, type="int",
+                                            help="End the game once one bot or the food has dominated for this many turns")
+        parser.add_option("--cutoff_percent", dest="cutoff_percent",
+                                            default=0.90, type="float",
+                                            help="Fraction of all ants and food that counts as dominating")
 
         (opts, args) = parser.parse_args(argv)
         if opts.runlocal != True:
@@ -469,6 +649,8 @@ class BatchLocalEngine:
                 "viewradius2": opts.viewradius2,
                 "attackradius2": opts.attackradius2,
                 "spawnradius2": opts.spawnradius2,
+                "cutoff_turn": opts.cutoff_turn,
+                "cutoff_percent": opts.cutoff_percent,
                 "loadtime": opts.loadtime,
                 "turntime": opts.turntime,
                 "turns": opts.turns,
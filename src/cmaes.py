@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# The covariance matrix adaptation evolution strategy (CMA-ES), for
+# optimizing bot weights from noisy game results.
+#
+# Each generation, ask() samples a population of weight vectors from a
+# multivariate normal distribution, the caller plays games with them,
+# and tell() moves the distribution towards the best ones: the mean
+# moves to a weighted average of the best half, and the covariance and
+# step size adapt to the directions that worked. Fitness is maximized.
+#
+# The full covariance matrix costs O(n^2) memory and an O(n^3)
+# eigendecomposition, which is fine for a few hundred weights. For
+# bigger models (e.g. hashed features), a diagonal covariance (sep-CMA)
+# scales linearly.
+#
+# The whole state of the search, including its random number generator,
+# can be saved with to_dict() and restored with CMAES.from_dict(), so
+# that long training runs can be checkpointed and resumed.
+
+import math
+
+import numpy as np
+
+class CMAES(object):
+    '''CMA-ES search distribution over weight vectors, maximizing fitness.'''
+
+    def __init__(self, mean, sigma=0.5, popsize=None, diagonal=False, seed=None):
+        '''Start a search at mean, with initial step size sigma. popsize defaults to
+        4 + 3 ln(n). If diagonal is true, only the variances of the weights are adapted.'''
+        self.mean = np.array(mean, dtype=float)
+        n = self.n = len(self.mean)
+        self.sigma = float(sigma)
+        self.diagonal = diagonal
+        self.popsize = popsize or 4 + int(3 * math.log(n))
+        self.rng = np.random.RandomState(seed)
+        self.generation = 0
+        self.best = None
+        self.best_fitness = None
+
+        # Recombination weights of the best mu solutions.
+        self.mu = self.popsize / 2
+        weights = math.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mueff = 1.0 / (self.weights ** 2).sum()
+
+        # Learning rates, from Hansen's "The CMA Evolution Strategy: A Tutorial".
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+        if diagonal:
+            # The diagonal can be learned faster (Ros & Hansen, 2008).
+            self.c1 = min(1.0, self.c1 * (n + 2) / 3.0)
+            self.cmu = min(1 - self.c1, self.cmu * (n + 2) / 3.0)
+        self.damps = 1 + 2 * max(0, math.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chi_n = math.sqrt(n) * (1 - 1.0 / (4 * n) + 1.0 / (21 * n ** 2))
+
+        # Evolution paths, and the covariance as C = B diag(D^2) B^T.
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        if diagonal:
+            self.C = np.ones(n)
+        else:
+            self.C = np.eye(n)
+        self._decompose()
+
+    def _decompose(self):
+        if self.diagonal:
+            self.B = None
+            self.D = np.sqrt(self.C)
+        else:
+            self.C = np.triu(self.C) + np.triu(self.C, 1).T
+            eigenvalues, self.B = np.linalg.eigh(self.C)
+            self.D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+
+    def _transform(self, z):
+        '''Map standard normal samples (rows of z) to samples from N(0, C).'''
+        if self.diagonal:
+            return z * self.D
+        return np.dot(z * self.D, self.B.T)
+
+    def _inverse_sqrt(self, y):
+        '''C^-1/2 y.'''
+        if self.diagonal:
+            return y / self.D
+        return np.dot(self.B, np.dot(self.B.T, y) / self.D)
+
+    def ask(self):
+        '''Sample a new population: a popsize x n array of weight vectors.'''
+        z = self.rng.standard_normal((self.popsize, self.n))
+        return self.mean + self.sigma * self._transform(z)
+
+    def tell(self, solutions, fitness):
+        '''Update the distribution from the fitness of each of the solutions returned by ask().'''
+        solutions = np.asarray(solutions, dtype=float)
+        fitness = np.asarray(fitness, dtype=float)
+        order = np.argsort(-fitness, kind='mergesort')
+
+        if self.best_fitness is None or fitness[order[0]] > self.best_fitness:
+            self.best = solutions[order[0]].copy()
+            self.best_fitness = float(fitness[order[0]])
+
+        n = self.n
+        y = (solutions[order[:self.mu]] - self.mean) / self.sigma
+        y_w = np.dot(self.weights, y)
+        self.mean = self.mean + self.sigma * y_w
+        self.generation += 1
+
+        # Step size path, and the covariance path (stalled while the step size is too small).
+        self.ps = (1 - self.cs) * self.ps + math.sqrt(self.cs * (2 - self.cs) * self.mueff) * self._inverse_sqrt(y_w)
+        ps_norm = np.linalg.norm(self.ps)
+        hsig = ps_norm / math.sqrt(1 - (1 - self.cs) ** (2 * self.generation)) / self.chi_n < 1.4 + 2.0 / (n + 1)
+        self.pc = (1 - self.cc) * self.pc + hsig * math.sqrt(self.cc * (2 - self.cc) * self.mueff) * y_w
+
+        # Rank one and rank mu updates of the covariance.
+        decay = 1 - self.c1 - self.cmu + (1 - hsig) * self.c1 * self.cc * (2 - self.cc)
+        if self.diagonal:
+            rank_mu = np.dot(self.weights, y ** 2)
+            self.C = decay * self.C + self.c1 * self.pc ** 2 + self.cmu * rank_mu
+        else:
+            rank_mu = np.dot(y.T * self.weights, y)
+            self.C = decay * self.C + self.c1 * np.outer(self.pc, self.pc) + self.cmu * rank_mu
+
+        self.sigma *= math.exp(min(1.0, (self.cs / self.damps) * (ps_norm / self.chi_n - 1)))
+        self._decompose()
+
+    def spread(self):
+        '''Largest standard deviation of the search distribution along any axis.'''
+        return self.sigma * float(self.D.max())
+
+    def converged(self, tolerance=1e-3):
+        return self.spread() < tolerance
+
+    def to_dict(self):
+        '''Convert the state of the search to a JSON-compatible dict.'''
+        state = self.rng.get_state()
+        return {'mean': self.mean.tolist(),
+                'sigma': self.sigma,
+                'popsize': self.popsize,
+                'diagonal': self.diagonal,
+                'generation': self.generation,
+                'best': None if self.best is None else self.best.tolist(),
+                'best_fitness': self.best_fitness,
+                'pc': self.pc.tolist(),
+                'ps': self.ps.tolist(),
+                'C': self.C.tolist(),
+                'rng': [state[0], state[1].tolist(), state[2], state[3], state[4]]}
+
+    @staticmethod
+    def from_dict(input_dict):
+        '''Restore a search saved with to_dict().'''
+        es = CMAES(input_dict['mean'], input_dict['sigma'], input_dict['popsize'], input_dict['diagonal'])
+        es.generation = input_dict['generation']
+        if input_dict['best'] is not None:
+            es.best = np.array(input_dict['best'])
+        es.best_fitness = input_dict['best_fitness']
+        es.pc = np.array(input_dict['pc'])
+        es.ps = np.array(input_dict['ps'])
+        es.C = np.array(input_dict['C'])
+        es._decompose()
+        rng = input_dict['rng']
+        es.rng.set_state((str(rng[0]), np.array(rng[1], dtype=np.uint32), rng[2], rng[3], rng[4]))
+        return es
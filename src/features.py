@@ -3,12 +3,17 @@ Created on Oct 1, 2011
 
 @author: djweiss
 '''
+import numpy as np
 
 class FeatureExtractor:
     ''' Extracts features from ant world state for given actions.
     
     This is the template class for all feature extractors. 
     A feature extractor must implement the init_from_dict() and extract() methods.  
+    
+    Extractors should get primitives such as the closest enemy/food/friend and next positions
+    from the GlobalState (e.g. state.closest_food(loc)), which memoizes them for the turn, 
+    rather than recomputing them. This keeps composite extractors cheap.
     '''
     
     def __init__(self, input_dict):
@@ -21,6 +26,8 @@ class FeatureExtractor:
             self.__class__ = QualifyingFeatures
         elif new_type == CompositingFeatures.type_name:
             self.__class__ = CompositingFeatures 
+        elif new_type == HashedFeatures.type_name:
+            self.__class__ = HashedFeatures
         else:
             raise Exception("Invalid feature class %s" + new_type)
 
@@ -71,6 +78,42 @@ class FeatureExtractor:
         
         raise NotImplementedError
 
+    def extract_batch(self, world, state, locs, actions):
+        """Extracts feature vectors for every location in locs and every action in actions at once.
+        
+        Returns a len(locs) x len(actions) x num_features() array, where entry [i, j] is the 
+        feature vector of extract(world, state, locs[i], actions[j]). This default implementation 
+        simply calls extract() for each pair; subclasses should override it with something faster.
+        """
+        
+        f = np.zeros((len(locs), len(actions), self.num_features()), dtype=bool)
+        for i, loc in enumerate(locs):
+            for j, action in enumerate(actions):
+                f[i, j, :] = self.extract(world, state, loc, action)
+        return f
+
+    def active_features(self, world, state, loc, action):
+        """Sparse version of extract(): returns an array of the ids of the active features."""
+        
+        return np.flatnonzero(self.extract(world, state, loc, action))
+
+    def score(self, world, state, loc, action, weights):
+        """Weighted sum of the active features for a single location and action."""
+        
+        if not weights.any():
+            return 0.0
+        return float(weights[self.active_features(world, state, loc, action)].sum())
+
+    def score_batch(self, world, state, locs, actions, weights):
+        """Weighted sum of the features for every location and action, as a len(locs) x len(actions) array.
+        
+        Extractors whose weights are all zero are not evaluated at all.
+        """
+        
+        if not weights.any():
+            return np.zeros((len(locs), len(actions)))
+        return np.dot(self.extract_batch(world, state, locs, actions), weights)
+
 class MovingTowardsFeatures(FeatureExtractor):
     """Very basic features.
     
@@ -93,27 +136,19 @@ class MovingTowardsFeatures(FeatureExtractor):
         
         return world.manhattan_distance(loc1, target) - world.manhattan_distance(loc2, target) > 0
 
-    def find_closest(self, world, loc, points):
-        """Returns the closest point to loc from the list points, or None if points is empty."""
-        if len(points) == 1:
-            return points[0]
+    def find_targets(self, world, state, loc):
+        """Returns the closest (enemy, food, friend) locations to loc, each of which may be None."""
         
-        locs = world.sort_by_distance(loc, points)
-            
-        if len(locs) > 0:
-            return locs[0][1]
-        else:
-            return None
+        return (state.closest_enemy(loc), state.closest_food(loc), state.closest_friend(loc))
         
     def extract(self, world, state, loc, action):
         """Extract the three simple features."""
         
-        food_loc = self.find_closest(world, loc, state.lookup_nearby_food(loc))
-        enemy_loc = self.find_closest(world, loc, state.lookup_nearby_enemy(loc))
-        friend_loc = self.find_closest(world, loc, state.lookup_nearby_friendly(loc))
+        enemy_loc, food_loc, friend_loc = self.find_targets(world, state, loc)
 
-        next_loc = world.next_position(loc, action)
-        world.L.debug("loc: %s, food_loc: %s, enemy_loc: %s, friendly_loc: %s" % (str(loc), str(food_loc), str(enemy_loc), str(friend_loc)))
+        next_loc = state.next_position(loc, action)
+        if world.debug_mode:
+            world.L.debug("loc: %s, food_loc: %s, enemy_loc: %s, friendly_loc: %s" % (str(loc), str(food_loc), str(enemy_loc), str(friend_loc)))
         # Feature vector        
         f = list()
         
@@ -136,6 +171,36 @@ class MovingTowardsFeatures(FeatureExtractor):
             f.append(self.moving_towards(world, loc, next_loc, friend_loc));
         
         return f
+
+    def extract_batch(self, world, state, locs, actions):
+        """Extract the three simple features for all locations and actions at once.
+        
+        The closest targets are found once per location; whether each action moves towards
+        them is then computed for all actions together.
+        """
+        
+        n = len(locs)
+        f = np.zeros((n, len(actions), 3), dtype=bool)
+        if n == 0 or len(actions) == 0:
+            return f
+        
+        # Closest (enemy, food, friend) of each location. Missing targets are masked out.
+        targets = np.zeros((n, 3, 2), dtype=int)
+        found = np.zeros((n, 3), dtype=bool)
+        for i, loc in enumerate(locs):
+            for k, targ in enumerate(self.find_targets(world, state, loc)):
+                if targ is not None:
+                    targets[i, k] = targ
+                    found[i, k] = True
+        
+        locs = np.asarray(locs, dtype=int).reshape(-1, 2)
+        next_locs = world.next_positions(locs, actions)
+        
+        # Distances to each target before (n x 1 x 3) and after (n x actions x 3) each action.
+        before = world.manhattan_distance_arrays(locs[:, np.newaxis, np.newaxis, :], targets[:, np.newaxis, :, :])
+        after = world.manhattan_distance_arrays(next_locs[:, :, np.newaxis, :], targets[:, np.newaxis, :, :])
+        f[:] = (before - after > 0) & found[:, np.newaxis, :]
+        return f
     
 class QualifyingFeatures(FeatureExtractor):
     """Additional qualifier-type features.
@@ -164,7 +229,13 @@ class CompositingFeatures(FeatureExtractor):
     n(m+1) features consisting of the original base_f features plus a copy of base_f features 
     that is multiplied by each of the qual_f features.
     
-    It is important to compute the unique names of each feature to help with debugging.
+    Features are usually booleans, so the products are logical ANDs. Features that are counts, 
+    like those of HashedFeatures, are multiplied as counts, the same way by extract(), 
+    extract_batch(), score() and score_batch().
+    
+    It is important to compute the unique names of each feature to help with debugging. The names
+    are built on demand by feature_name(), so that compositions of compositions don't have to 
+    enumerate every name up front; call compute_feature_names() to fill in the full list.
 
     """
     
@@ -178,14 +249,23 @@ class CompositingFeatures(FeatureExtractor):
         self.base_f = FeatureExtractor(input_dict['base_f']) 
         self.qual_f = FeatureExtractor(input_dict['qual_f']) 
 
-        # Compute names based on the features we've loaded    
-        self.compute_feature_names()
-
     def to_dict(self):
         val =  FeatureExtractor.to_dict(self)
         val['base_f'] = self.base_f.to_dict()
         val['qual_f'] = self.qual_f.to_dict()
         return val
+    
+    def num_features(self):
+        return self.base_f.num_features() * (self.qual_f.num_features() + 1)
+    
+    def feature_name(self, fid):
+        """Name of the fid'th feature, computed from the names of the base_f and qual_f features."""
+        
+        n = self.base_f.num_features()
+        if fid < n:
+            return self.base_f.feature_name(fid)
+        qual_id, base_id = divmod(fid - n, n)
+        return "%s AND %s" % (self.base_f.feature_name(base_id), self.qual_f.feature_name(qual_id))
         
     def compute_feature_names(self):
         """ Compute the list of feature names from the composition of base_f and qual_f. The
@@ -198,13 +278,243 @@ class CompositingFeatures(FeatureExtractor):
         f[mn] through f[(m+1)n-1]: base_f[n-1]*qual_f[m-1] through base_f[n-1]*qual_f[m-1] 
                 
         """
-        self.feature_names.extend(self.base_f.feature_names)
+        if self.feature_names:
+            return self.feature_names
         
-        raise NotImplementedError
+        for fid in range(self.num_features()):
+            self.feature_names.append(self.feature_name(fid))
+            self.feature_id[self.feature_names[-1]] = fid
+        return self.feature_names
+    
+    def compose(self, base, qual):
+        """Combine base and qualifier feature arrays (over the last axis) into composite features."""
+        
+        products = qual[..., :, np.newaxis] * base[..., np.newaxis, :]
+        products = products.reshape(base.shape[:-1] + (-1,))
+        return np.concatenate((base, products), axis=-1)
     
     def extract(self, world, state, loc, action):
-        """Extracts the combination of features according to the ordering defined by compute_feature_names()."""
-        raise NotImplementedError
+        """Extracts the combination of features according to the ordering defined by compute_feature_names().
+        
+        Each of base_f and qual_f is evaluated once, and the products are formed as an outer product.
+        Returns a NumPy array of booleans, or of counts if base_f or qual_f has counts.
+        """
+        base = np.asarray(self.base_f.extract(world, state, loc, action))
+        qual = np.asarray(self.qual_f.extract(world, state, loc, action))
+        return self.compose(base, qual)
 
+    def extract_batch(self, world, state, locs, actions):
+        """Batch version of extract(), built from the batch outputs of base_f and qual_f."""
+        
+        base = np.asarray(self.base_f.extract_batch(world, state, locs, actions))
+        qual = np.asarray(self.qual_f.extract_batch(world, state, locs, actions))
+        return self.compose(base, qual)
+
+    def active_features(self, world, state, loc, action):
+        """Returns the ids of the active features, computed from the active ids of base_f and qual_f
+        without building the dense feature vector. An id appears as often as its count."""
+        
+        n = self.base_f.num_features()
+        base = self.base_f.active_features(world, state, loc, action)
+        qual = self.qual_f.active_features(world, state, loc, action)
+        products = n + qual[:, np.newaxis]*n + base[np.newaxis, :]
+        return np.concatenate((base, products.ravel()))
 
-                       
\ No newline at end of file
+    def _split_weights(self, weights):
+        """Split a weight vector into base weights (n) and product weights (m x n)."""
+        
+        n = self.base_f.num_features()
+        return weights[:n], weights[n:].reshape(-1, n)
+
+    def score(self, world, state, loc, action, weights):
+        """Weighted sum of the active features. qual_f is skipped when all product weights are zero."""
+        
+        base_weights, product_weights = self._split_weights(weights)
+        if not product_weights.any():
+            return self.base_f.score(world, state, loc, action, base_weights)
+        return FeatureExtractor.score(self, world, state, loc, action, weights)
+
+    def score_batch(self, world, state, locs, actions, weights):
+        """Batch version of score(), without forming the n(m+1) composite features. qual_f is skipped
+        when all product weights are zero."""
+        
+        base_weights, product_weights = self._split_weights(weights)
+        if not product_weights.any():
+            return self.base_f.score_batch(world, state, locs, actions, base_weights)
+        
+        base = self.base_f.extract_batch(world, state, locs, actions).astype(float)
+        qual = self.qual_f.extract_batch(world, state, locs, actions).astype(float)
+        
+        # value = base . base_weights + sum_j qual_j * (base . product_weights[j])
+        return np.dot(base, base_weights) + (qual * np.dot(base, product_weights.T)).sum(axis=-1)
+
+class HashedFeatures(FeatureExtractor):
+    """Hashes the features of another FeatureExtractor into a fixed number of buckets.
+    
+    The id of every active source_f feature is hashed to one of num_buckets buckets, and the value
+    of a bucket is the number of active features that landed in it. The weight vector therefore has
+    num_buckets entries no matter how many features source_f has, and source_f never has to 
+    enumerate its feature names. Features that share a bucket share a weight; collision_stats()
+    reports how often that happens.
+    """
+    
+    type_name = 'Hashed'
+    
+    # Source extractors with at most this many features are scored in batch through their dense
+    # extract_batch(); larger ones are scored one ant and action at a time from their active features.
+    dense_limit = 4096
+    
+    def __init__(self, source_f, num_buckets=4096, seed=0):
+        FeatureExtractor.__init__(self, {'_type': HashedFeatures.type_name, 'source_f': source_f.to_dict(),
+                                         'num_buckets': num_buckets, 'seed': seed})
+    
+    def init_from_dict(self, input_dict):
+        self.source_f = FeatureExtractor(input_dict['source_f'])
+        self.num_buckets = int(input_dict['num_buckets'])
+        self.seed = int(input_dict.get('seed', 0))
+        self.bucket_table = None
+        
+    def to_dict(self):
+        val = FeatureExtractor.to_dict(self)
+        val['source_f'] = self.source_f.to_dict()
+        val['num_buckets'] = self.num_buckets
+        val['seed'] = self.seed
+        return val
+    
+    def num_features(self):
+        return self.num_buckets
+    
+    def feature_name(self, fid):
+        return "Hash bucket %d" % fid
+    
+    def bucket(self, fids):
+        """Bucket of each of the source feature ids in fids (a 64-bit integer mix of the id and seed)."""
+        
+        x = np.asarray(fids, dtype=np.uint64) + np.uint64((self.seed * 0x9E3779B97F4A7C15) % 2**64)
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+        return (x % np.uint64(self.num_buckets)).astype(int)
+    
+    def source_buckets(self):
+        """Bucket of every source feature, computed once. Only used when source_f is small."""
+        
+        if self.bucket_table is None:
+            self.bucket_table = self.bucket(np.arange(self.source_f.num_features()))
+        return self.bucket_table
+    
+    def collision_stats(self, chunk_size=1000000):
+        """Returns a dict describing how the source features are spread over the buckets.
+        
+        colliding_features counts the source features that share their bucket with at least 
+        one other feature. Source ids are hashed in chunks, so this also works for very 
+        large source_f.
+        """
+        
+        num_source = self.source_f.num_features()
+        load = np.zeros(self.num_buckets, dtype=int)
+        for start in range(0, num_source, chunk_size):
+            ids = np.arange(start, min(start + chunk_size, num_source))
+            load += np.bincount(self.bucket(ids), minlength=self.num_buckets)
+        
+        colliding = int(load[load > 1].sum())
+        return {'source_features': num_source, 
+                'buckets': self.num_buckets,
+                'used_buckets': int(np.count_nonzero(load)),
+                'colliding_features': colliding,
+                'collision_rate': colliding / float(max(num_source, 1)),
+                'max_load': int(load.max()) if self.num_buckets else 0}
+    
+    def active_features(self, world, state, loc, action):
+        """Buckets of the active source features. A bucket appears once per feature that hashes to it."""
+        
+        return self.bucket(self.source_f.active_features(world, state, loc, action))
+    
+    def extract(self, world, state, loc, action):
+        """Returns the bucket counts as a NumPy array of length num_buckets."""
+        
+        return np.bincount(self.active_features(world, state, loc, action), minlength=self.num_buckets)
+    
+    def extract_batch(self, world, state, locs, actions):
+        f = np.zeros((len(locs), len(actions), self.num_buckets), dtype=int)
+        if self.source_f.num_features() <= HashedFeatures.dense_limit:
+            rows, cols, fids = np.nonzero(self.source_f.extract_batch(world, state, locs, actions))
+            np.add.at(f, (rows, cols, self.source_buckets()[fids]), 1)
+        else:
+            for i, loc in enumerate(locs):
+                for j, action in enumerate(actions):
+                    f[i, j, :] = self.extract(world, state, loc, action)
+        return f
+    
+    def score_batch(self, world, state, locs, actions, weights):
+        """Batch version of score(). Small source extractors are scored with a dot product against
+        the weights of their buckets, so the num_buckets features are never formed."""
+        
+        if not weights.any():
+            return np.zeros((len(locs), len(actions)))
+        if self.source_f.num_features() <= HashedFeatures.dense_limit:
+            return self.source_f.score_batch(world, state, locs, actions, weights[self.source_buckets()])
+        
+        values = np.zeros((len(locs), len(actions)))
+        for i, loc in enumerate(locs):
+            for j, action in enumerate(actions):
+                values[i, j] = self.score(world, state, loc, action, weights)
+        return values
+
+if __name__ == '__main__':
+    # Check that extract(), extract_batch(), score() and score_batch() agree on random worlds,
+    # for composites of boolean features and of hashed features, whose values are counts.
+    import random
+    import worldstate
+    from state import GlobalState
+    
+    rows, cols = 40, 40
+    actions = ['n', 'e', 's', 'w']
+    def random_loc():
+        return (random.randrange(rows), random.randrange(cols))
+    
+    moving = MovingTowardsFeatures()
+    pairs = CompositingFeatures(moving, moving)
+    extractors = [("pairs", pairs),
+                  ("hashed pairs", HashedFeatures(pairs, 8)),
+                  ("hashed pairs x moving", CompositingFeatures(HashedFeatures(pairs, 8), moving)),
+                  ("moving x hashed pairs", CompositingFeatures(moving, HashedFeatures(pairs, 8))),
+                  ("hashed pairs x hashed pairs", CompositingFeatures(HashedFeatures(pairs, 8), 
+                                                                      HashedFeatures(pairs, 4, seed=1)))]
+    
+    random.seed(0)
+    np.random.seed(0)
+    worst = dict((i, 0.0) for i in range(len(extractors)))
+    for trial in range(20):
+        world = worldstate.AntWorld()
+        world.L.setLevel(50)
+        world.stateless = True
+        world._setup_parameters("rows %d\ncols %d" % (rows, cols))
+        ant_locs = list(set(random_loc() for i in range(10)))
+        enemies = [loc for loc in set(random_loc() for i in range(10)) if loc not in ant_locs]
+        world._update('\n'.join(['a %d %d 0' % loc for loc in ant_locs] + 
+                                 ['f %d %d' % random_loc() for i in range(10)] + 
+                                 ['a %d %d 1' % loc for loc in enemies]))
+        state = GlobalState(world, resolution=10, draw_heatmap=False)
+        
+        for i, (name, f) in enumerate(extractors):
+            weights = np.random.randn(f.num_features())
+            weight_sets = [weights]
+            if isinstance(f, CompositingFeatures):
+                # Also check scoring without the qualifiers.
+                only_base = weights.copy()
+                only_base[f.base_f.num_features():] = 0
+                weight_sets.append(only_base)
+            
+            dense = np.array([[f.extract(world, state, loc, a) for a in actions] for loc in ant_locs])
+            assert (dense == f.extract_batch(world, state, ant_locs, actions)).all()
+            for w in weight_sets:
+                expected = np.dot(dense, w)
+                single = [[f.score(world, state, loc, a, w) for a in actions] for loc in ant_locs]
+                for values in (single, f.score_batch(world, state, ant_locs, actions, w)):
+                    worst[i] = max(worst[i], np.abs(np.asarray(values) - expected).max())
+    
+    for i, (name, f) in enumerate(extractors):
+        print "%s: largest score difference from extract() %.2g" % (name, worst[i])
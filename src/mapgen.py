@@ -3,6 +3,8 @@
 import math
 import random
 
+import numpy as np
+
 #functions	
 def gcd(a, b):
     while b:
@@ -33,7 +35,8 @@ class SymmetricMap():
     a_loc = c_locs = []
     
     def __init__(self, min_players=2, max_players=2, min_dim=20, max_dim=20, 
-                 min_start_distance=5, min_land_proportion=0.75, max_land_proportion=0.9):
+                 min_start_distance=5, min_land_proportion=0.75, max_land_proportion=0.9, seed=None,
+                 vectorized=False):
         #game parameters
         self.min_players = min_players
         self.max_players = max_players
@@ -42,9 +45,27 @@ class SymmetricMap():
         self.min_start_distance = min_start_distance
         self.min_land_proportion = min_land_proportion
         self.max_land_proportion = max_land_proportion
+        
+        #maps with a seed are always the same, otherwise the global random stream is used
+        self.seed = seed
+        
+        #vectorized maps are carved with numpy; they look the same, but differ from the
+        #maps made from the same seed by the original generator
+        self.vectorized = vectorized
 
     #makes a map by performing a bunch of random walks carving out water
     def random_walk_map(self):
+        if self.seed is None:
+            self.random = random
+        else:
+            self.random = random.Random(self.seed)
+        
+        #union-find over the squares that aren't water, once connectivity needs checking often
+        self.parent = None
+        
+        if self.vectorized:
+            self.vector_walk_map()
+            return
         self.pick_dimensions()
         self.map_data = [ ['%' for c in range(self.cols)] for r in range(self.rows) ]
         self.add_ants()
@@ -69,24 +90,43 @@ class SymmetricMap():
         return txt
         
     #picks the dimensions of the map
+    #on large maps almost every draw is rejected, so rather than calling self.random.randint()
+    #for every value, this calls self.random.random() directly: for ranges this small,
+    #randint(a, b) is a + int(random()*(b-a+1)), so the same maps come out of the same seeds
     def pick_dimensions(self):
+        if self.min_dim < 6:
+            raise ValueError("maps need at least 6 rows and columns")
+        rand = self.random.random
+        dim_range = self.max_dim - self.min_dim + 1
+        
+        #the number of players of each translation that gives a valid number of players, by size
+        players = {}
+        
         while True:
-            while True:
-                self.rows = random.randint(self.min_dim, self.max_dim)
-                self.cols = random.randint(self.min_dim, self.max_dim)
+            rows = self.min_dim + int(rand()*dim_range)
+            cols = self.min_dim + int(rand()*dim_range)
+            row_t = 3 + int(rand()*(rows-5))
+            col_t = 3 + int(rand()*(cols-5))
             
-                self.row_t = random.randint(3, self.rows-3)
-                self.col_t = random.randint(3, self.cols-3)
-                
-                #makes sure no two players start in the same row or column
-                if self.rows/gcd(self.row_t, self.rows) == self.cols/gcd(self.col_t, self.cols):
-                    break
-
-            self.no_players = lcm(self.rows/gcd(self.row_t, self.rows), 
-                                  self.cols/gcd(self.col_t, self.cols) )
+            for n in (rows, cols):
+                if n not in players:
+                    players[n] = {}
+                    for t in range(3, n-2):
+                        if self.min_players <= n/gcd(t, n) <= self.max_players:
+                            players[n][t] = n/gcd(t, n)
+            
+            #makes sure no two players start in the same row or column, and forces a valid 
+            #number of players
+            no_players = players[rows].get(row_t)
+            if no_players is None or players[cols].get(col_t) != no_players:
+                continue
+            
+            self.rows, self.cols = rows, cols
+            self.row_t, self.col_t = row_t, col_t
+            self.no_players = no_players
             
-            #forces a valid number of players all starting at a valid distance
-            if self.no_players >= self.min_players and self.no_players <= self.max_players and self.is_valid_start():
+            #forces all players starting at a valid distance
+            if self.is_valid_start():
                 break
     
     #returns the distance between two squares
@@ -99,7 +139,7 @@ class SymmetricMap():
     
     #randomly picks a location inside the map
     def pick_square(self):
-        return [random.randint(0, self.rows-1), random.randint(0, self.cols-1)]
+        return [self.random.randint(0, self.rows-1), self.random.randint(0, self.cols-1)]
 
     #starts two random walks from the players starting ants
     def start_walks(self):
@@ -110,7 +150,7 @@ class SymmetricMap():
     #walks the random walk locations
     def walk_locations(self):
         for c in range(len(self.c_locs)):
-            d = self.cdirections[random.randint(0, 3)]
+            d = self.cdirections[self.random.randint(0, 3)]
             self.c_locs[c] = self.get_loc(self.c_locs[c], d)
     
     #returns the new location after moving in a particular direction
@@ -127,7 +167,10 @@ class SymmetricMap():
     def fill_squares(self, loc, type):
         value = type
         for n in range(self.no_players):
+            was_water = self.map_data[loc[0] ][loc[1] ] == '%'
             self.map_data[loc[0] ][loc[1] ] = value
+            if was_water and self.parent is not None:
+                self.join_square(loc)
             if type == 'a':
                 value = chr(ord(value)+1)
             loc = self.get_translate_loc(loc)
@@ -141,7 +184,49 @@ class SymmetricMap():
                 return False
         return True
     
-    #checks whether the players can reach every non-wall square
+    #returns the representative of the connected component of square i
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i] ]
+            i = parent[i]
+        return i
+    
+    #joins the components of squares i and j
+    def union(self, i, j):
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        self.components -= 1
+    
+    #sets up the union-find from the connected components of the squares that aren't water
+    def start_union_find(self):
+        land = (np.array(self.map_data) != '%').ravel()
+        labels = self.vector_labels(land.reshape(self.rows, self.cols)).ravel()
+        self.parent = np.where(land, labels, np.arange(self.rows*self.cols)).tolist()
+        self.size = [1]*(self.rows*self.cols)
+        self.components = len(np.unique(labels[land]))
+    
+    #adds a square that was just carved out of the water to the union-find
+    def join_square(self, loc):
+        r, c = loc
+        i = r*self.cols + c
+        self.components += 1
+        for n_r, n_c in (((r-1)%self.rows, c), (r, (c+1)%self.cols), 
+                         ((r+1)%self.rows, c), (r, (c-1)%self.cols)):
+            if self.map_data[n_r][n_c] != '%':
+                self.union(i, n_r*self.cols + n_c)
+    
+    #checks whether the players can reach every non-wall square, in constant time
+    def is_connected(self):
+        return self.components == 1
+    
+    #checks whether the players can reach every non-wall square, by searching the whole map
     def is_valid(self):
         start_loc = self.a_loc
         visited = [ [False for c in range(self.cols)] for r in range(self.rows)]
@@ -172,16 +257,143 @@ class SymmetricMap():
     #adds land to a map of water
     def add_walk_land(self):
         #random.gauss(2,10)
-        no_land_squares = random.randint(int(self.min_land_proportion*self.rows*self.cols), 
+        no_land_squares = self.random.randint(int(self.min_land_proportion*self.rows*self.cols), 
                                           int(self.max_land_proportion*self.rows*self.cols))
         
-        while self.land_squares < no_land_squares or not self.is_valid():
-            self.walk_locations()
+        while self.land_squares < no_land_squares:
+            self.walk_land()
+        
+        #with plenty of land, the map is usually connected by now, which a single search
+        #shows; otherwise keep walking, with a union-find to check connectivity at every step
+        if not self.is_valid():
+            self.start_union_find()
+            while not self.is_connected():
+                self.walk_land()
+    
+    #walks the random walk locations, carving out the water they reach
+    def walk_land(self):
+        self.walk_locations()
+
+        for c_loc in self.c_locs:
+            if self.map_data[c_loc[0]][c_loc[1]] == '%':
+                self.land_squares += self.no_players
+                self.fill_squares(c_loc, '.')
 
-            for c_loc in self.c_locs:
-                if self.map_data[c_loc[0]][c_loc[1]] == '%':
-                    self.land_squares += self.no_players
-                    self.fill_squares(c_loc, '.')
+    #number of steps all walkers take at once when carving with numpy
+    vector_steps = 64
+    
+    #the same random walks as random_walk_map(), with all walkers moved for a batch of steps at
+    #once and every symmetric copy of a square carved together: squares are grouped into orbits
+    #of the translation, and the walks carve whole orbits
+    def vector_walk_map(self):
+        rng = np.random.RandomState(self.random.getrandbits(32))
+        self.vector_pick_dimensions(rng)
+        rows, cols = self.rows, self.cols
+        
+        #orbit of each square, named by its lowest index
+        r, c = np.indices((rows, cols))
+        self.orbit = r*cols + c
+        for n in range(1, self.no_players):
+            r = (r + self.row_t) % rows
+            c = (c + self.col_t) % cols
+            self.orbit = np.minimum(self.orbit, r*cols + c)
+        self.orbit = self.orbit.ravel()
+        self.carved = np.zeros(rows*cols, dtype=bool)
+        
+        self.land_squares = self.no_players
+        self.a_loc = self.pick_square()
+        self.carved[self.orbit[self.a_loc[0]*cols + self.a_loc[1] ] ] = True
+        self.start_walks()
+        
+        no_land_squares = self.random.randint(int(self.min_land_proportion*rows*cols), 
+                                              int(self.max_land_proportion*rows*cols))
+        
+        #carve whole batches until the step that reaches the amount of land
+        locs = np.array(self.c_locs)
+        while True:
+            path, new_orbits, new_steps = self.vector_walk(rng, locs)
+            land = self.land_squares + self.no_players*np.arange(1, len(new_orbits)+1)
+            if len(land) > 0 and land[-1] >= no_land_squares:
+                last_step = new_steps[np.argmax(land >= no_land_squares)]
+                new_orbits = new_orbits[new_steps <= last_step]
+                self.carved[new_orbits] = True
+                self.land_squares += len(new_orbits)*self.no_players
+                locs = path[last_step]
+                break
+            self.carved[new_orbits] = True
+            self.land_squares += len(new_orbits)*self.no_players
+            locs = path[-1]
+        
+        #write out the map, with the ants on their symmetric squares
+        grid = np.where(self.carved[self.orbit].reshape(rows, cols), '.', '%')
+        loc = self.a_loc
+        for n in range(self.no_players):
+            grid[loc[0], loc[1] ] = chr(ord('a') + n)
+            loc = self.get_translate_loc(loc)
+        self.map_data = grid.tolist()
+        
+        #the map is rarely connected yet, so set up the union-find from its components, and
+        #carve the remaining steps one orbit at a time until it is
+        self.start_union_find()
+        while self.components > 1:
+            path, new_orbits, new_steps = self.vector_walk(rng, locs)
+            locs = path[-1]
+            for i in range(len(new_orbits)):
+                self.fill_squares([new_orbits[i] / cols, new_orbits[i] % cols], '.')
+                self.carved[new_orbits[i] ] = True
+                self.land_squares += self.no_players
+                if self.components == 1 and (i == len(new_orbits)-1 or new_steps[i+1] != new_steps[i]):
+                    locs = path[new_steps[i] ]
+                    break
+        self.c_locs = locs.tolist()
+    
+    #picks the dimensions of the map like pick_dimensions(), trying a batch of them at once
+    def vector_pick_dimensions(self, rng, batch=4096):
+        while True:
+            rows = rng.randint(self.min_dim, self.max_dim+1, batch)
+            cols = rng.randint(self.min_dim, self.max_dim+1, batch)
+            row_t = 3 + (rng.random_sample(batch)*(rows-5)).astype(int)
+            col_t = 3 + (rng.random_sample(batch)*(cols-5)).astype(int)
+            
+            #the number of players is the same along rows and columns, and within limits
+            row_players = rows / np.gcd(row_t, rows)
+            col_players = cols / np.gcd(col_t, cols)
+            valid = (row_players == col_players) & (row_players >= self.min_players) & (row_players <= self.max_players)
+            for i in np.flatnonzero(valid):
+                self.rows, self.cols = int(rows[i]), int(cols[i])
+                self.row_t, self.col_t = int(row_t[i]), int(col_t[i])
+                self.no_players = int(row_players[i])
+                if self.is_valid_start():
+                    return
+    
+    #walks all walkers from locs for a batch of steps; returns their path, and the orbits that
+    #weren't carved yet in the order they are reached, with the step each is reached at
+    def vector_walk(self, rng, locs):
+        steps = np.array([self.directions[d] for d in self.cdirections])
+        moves = steps[rng.randint(0, 4, (self.vector_steps, len(locs)))]
+        path = (locs + np.cumsum(moves, axis=0)) % [self.rows, self.cols]
+        orbits = self.orbit[path[:, :, 0]*self.cols + path[:, :, 1] ].ravel()
+        
+        new_orbits, first = np.unique(orbits, return_index=True)
+        is_new = ~self.carved[new_orbits]
+        new_orbits, first = new_orbits[is_new], first[is_new]
+        order = np.argsort(first)
+        return path, new_orbits[order], first[order] / len(locs)
+    
+    #labels each square of land with the lowest index of a square it is connected to, by
+    #propagating labels to neighbours, and pointer jumping to shorten long paths
+    def vector_labels(self, land):
+        n = land.size
+        labels = np.where(land, np.arange(n).reshape(land.shape), n)
+        while True:
+            lowest = labels
+            for shift, axis in ((1, 0), (-1, 0), (1, 1), (-1, 1)):
+                lowest = np.minimum(lowest, np.roll(labels, shift, axis))
+            lowest = np.where(land, lowest, n)
+            lowest[land] = lowest.ravel()[lowest[land] ]
+            if (lowest == labels).all():
+                return labels
+            labels = lowest
 
 if __name__ == '__main__':
     import optparse
@@ -193,11 +405,13 @@ if __name__ == '__main__':
                      dest="min_dim", help="Map min dimensions.")
     parse.add_option("-u", "--max_dimensions", default=30, type="int",
                      dest="max_dim", help="Map max dimensions.")
+    parse.add_option("-v", "--vectorized", default=False, action="store_true",
+                     dest="vectorized", help="Generate the map with numpy.")
 
     (options, args) = parse.parse_args()
     
     example_map = SymmetricMap(min_players=options.num_players, max_players=options.num_players,
-                               min_dim=options.min_dim, max_dim=options.max_dim)
+                               min_dim=options.min_dim, max_dim=options.max_dim, vectorized=options.vectorized)
     example_map.random_walk_map()
     example_map.print_map()
 
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# A pool of pre-generated random maps for tournaments and training.
+#
+# Generating a random walk map can take longer than playing a 100 turn
+# game on it, so rather than making a new map for every game,
+# BatchLocalEngine.RunTournament() can draw its maps from a MapPool.
+# The pool holds a fixed number of maps per size bucket (a [min_dim,
+# max_dim] range), generated in parallel the first time the bucket is
+# used and cached on disk as JSON, one file per bucket. Every map is
+# stored with the seed it was generated from and a hash of its text, so
+# that the cache can be checked when it is loaded, and results recorded
+# for a map (see results.py) refer to the same map in every run.
+#
+# Tournaments rotate through the maps of a bucket: each draw starts
+# where the previous one stopped, or at a position given by the
+# tournament's seed.
+#
+# Vectorized pools are generated with the numpy map generator (see
+# SymmetricMap.vector_walk_map()), which is much faster on large maps,
+# and are cached separately, with seeds of their own.
+#
+# To fill the cache ahead of time:
+#   python src/mappool.py -n 100 --dims 30 30 --dims 40 60
+
+import hashlib
+import json
+import os
+import random
+from multiprocessing import Pool
+from optparse import OptionParser
+
+from mapgen import SymmetricMap
+
+def map_hash(text):
+    return hashlib.sha1(text).hexdigest()[:16]
+
+def generate_map(args):
+    '''Generate the map with the given (seed, min_dim, max_dim, vectorized), as a pool entry. 
+    This is a function so that it can be used with Pool.map().'''
+    (map_seed, min_dim, max_dim, vectorized) = args
+    random_map = SymmetricMap(min_dim=min_dim, max_dim=max_dim, seed=map_seed, vectorized=vectorized)
+    random_map.random_walk_map()
+    text = random_map.map_text()
+    return {'seed': map_seed, 'hash': map_hash(text), 'text': text}
+
+class MapPool(object):
+    '''A fixed set of maps per size bucket, cached in directory.'''
+
+    def __init__(self, directory='maps/pool', size=100, seed=0, processes=None, vectorized=False):
+        '''Pools have size maps per bucket, whose seeds are generated from seed. Maps are
+        generated with processes worker processes (default: one per CPU), with the numpy 
+        generator if vectorized is true.'''
+        self.directory = directory
+        self.size = size
+        self.seed = seed
+        self.processes = processes
+        self.vectorized = vectorized
+        self.buckets = {}
+        self.cursors = {}
+
+    def filename(self, map_dims):
+        name = "pool_%d_%d_n%d_s%d" % (map_dims[0], map_dims[1], self.size, self.seed)
+        if self.vectorized:
+            name += "_v"
+        return os.path.join(self.directory, name + ".json")
+
+    def map_seeds(self, map_dims):
+        rng = random.Random((self.seed * 1000 + map_dims[0]) * 1000 + map_dims[1])
+        seeds = [rng.getrandbits(31) for i in range(self.size)]
+        if self.vectorized:
+            # Keep the seeds of the two generators apart, since results are stored by map seed.
+            seeds = [s + 2**31 for s in seeds]
+        return seeds
+
+    def load(self, map_dims):
+        '''Load the cached maps of a bucket, or return None if the cache is missing or
+        doesn't match this pool.'''
+        filename = self.filename(map_dims)
+        if not os.path.exists(filename):
+            return None
+
+        fp = open(filename, 'r')
+        try:
+            maps = json.load(fp)
+        except ValueError:
+            return None
+        finally:
+            fp.close()
+
+        if [m['seed'] for m in maps] != self.map_seeds(map_dims):
+            return None
+        for m in maps:
+            if map_hash(m['text']) != m['hash']:
+                return None
+        return maps
+
+    def save(self, map_dims, maps):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        filename = self.filename(map_dims)
+        fp = open(filename + ".tmp", 'w')
+        json.dump(maps, fp)
+        fp.close()
+        os.rename(filename + ".tmp", filename)
+
+    def prepare(self, buckets):
+        '''Make sure that the maps of all of the given buckets are available, loading them
+        from the cache, or generating all of the missing ones in parallel.'''
+        missing = []
+        for map_dims in buckets:
+            map_dims = tuple(map_dims)
+            if map_dims in self.buckets:
+                continue
+            maps = self.load(map_dims)
+            if maps is None:
+                missing.append(map_dims)
+            else:
+                self.buckets[map_dims] = maps
+        if len(missing) == 0:
+            return
+
+        jobs = [(map_seed, map_dims[0], map_dims[1], self.vectorized) 
+                for map_dims in missing for map_seed in self.map_seeds(map_dims)]
+        if self.processes == 1:
+            maps = map(generate_map, jobs)
+        else:
+            pool = Pool(self.processes)
+            try:
+                maps = pool.map(generate_map, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        for i, map_dims in enumerate(missing):
+            self.buckets[map_dims] = maps[i*self.size:(i+1)*self.size]
+            self.save(map_dims, self.buckets[map_dims])
+
+    def bucket(self, map_dims):
+        '''All maps of a bucket, as a list of dicts with keys 'seed', 'hash' and 'text'.'''
+        self.prepare([map_dims])
+        return self.buckets[tuple(map_dims)]
+
+    def maps(self, map_dims, num_maps, start=None):
+        '''Draw num_maps maps of a bucket, rotating through the pool. They start at position
+        start (modulo the size of the pool), or where the last draw stopped.'''
+        maps = self.bucket(map_dims)
+        map_dims = tuple(map_dims)
+        if start is None:
+            start = self.cursors.get(map_dims, 0)
+        self.cursors[map_dims] = (start + num_maps) % self.size
+        return [maps[(start + i) % self.size] for i in range(num_maps)]
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("-n", "--size", dest="size", default=100, type="int",
+                      help="Number of maps per size bucket")
+    parser.add_option("--dims", dest="dims", default=[], action="append", nargs=2, type="int",
+                      help="Size bucket MIN_DIM MAX_DIM to generate (may be repeated)")
+    parser.add_option("-d", "--directory", dest="directory", default="maps/pool",
+                      help="Directory to cache the pool in")
+    parser.add_option("--seed", dest="seed", default=0, type="int",
+                      help="Seed the map seeds are generated from")
+    parser.add_option("-j", "--processes", dest="processes", default=None, type="int",
+                      help="Number of worker processes (default: one per CPU)")
+    parser.add_option("-v", "--vectorized", dest="vectorized", default=False, action="store_true",
+                      help="Generate the maps with the numpy generator")
+    (opts, args) = parser.parse_args()
+
+    map_pool = MapPool(opts.directory, opts.size, opts.seed, opts.processes, opts.vectorized)
+    map_pool.prepare(opts.dims or [(30, 30)])
+    for map_dims in sorted(map_pool.buckets):
+        print "%s: %d maps in %s" % (list(map_dims), opts.size, map_pool.filename(map_dims))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Reading and writing ValueBot models (a FeatureExtractor and its
+# weights) in a compact binary format.
+#
+# A model file starts with a fixed header: the magic string 'VBOT', a
+# format version (uint16) and the length of a JSON header (uint32). The
+# JSON header holds FeatureExtractor.to_dict() and the number of
+# weights. It is padded so that the weights, a little-endian float32
+# array, start on an 8 byte boundary and can be memory-mapped directly
+# instead of being parsed.
+#
+# Models saved by older versions of ValueBot are JSON files with
+# 'features' and 'weights' keys. load_model() reads those too, and falls
+# back to the JSON file next to a missing binary file, so that existing
+# bots in saved_bots/ keep working.
+#
+# Run this module with a list of JSON model files to convert them.
+
+import json
+import os
+import os.path
+import struct
+
+import numpy as np
+
+from features import FeatureExtractor
+
+MAGIC = 'VBOT'
+VERSION = 1
+PREFIX = struct.Struct('<4sHI')
+WEIGHT_DTYPE = np.dtype('<f4')
+
+class ModelFormatError(Exception):
+    pass
+
+def save_model(filename, features, weights):
+    '''Save features and weights to filename in the binary format.'''
+    # Copy the weights first: they may be memory-mapped from the file being replaced.
+    data = np.array(weights, dtype=WEIGHT_DTYPE).tostring()
+    header = json.dumps({'features': features.to_dict(), 'num_weights': len(data) / WEIGHT_DTYPE.itemsize})
+    header += ' ' * (-(PREFIX.size + len(header)) % 8)
+
+    # Write to a temporary file, so that a failed save leaves the old model in place.
+    fp = open(filename + ".tmp", 'wb')
+    fp.write(PREFIX.pack(MAGIC, VERSION, len(header)))
+    fp.write(header)
+    fp.write(data)
+    fp.close()
+    os.rename(filename + ".tmp", filename)
+
+def save_json_model(filename, features, weights):
+    '''Save features and weights to filename in the original JSON format.'''
+    fp = open(filename + ".tmp", 'w')
+    json.dump({'features': features.to_dict(),
+               'weights': [float(w) for w in weights]}, fp)
+    fp.close()
+    os.rename(filename + ".tmp", filename)
+
+def is_binary_model(filename):
+    fp = open(filename, 'rb')
+    magic = fp.read(len(MAGIC))
+    fp.close()
+    return magic == MAGIC
+
+def model_file(filename):
+    '''Get the file that load_model() would read for filename, or None if there is none.'''
+    if os.path.exists(filename):
+        return filename
+    stem, ext = os.path.splitext(filename)
+    if ext != '.json' and os.path.exists(stem + '.json'):
+        return stem + '.json'
+    return None
+
+def load_model(filename, mmap=True):
+    '''Load (features, weights) from a binary or JSON model file.
+
+    If filename doesn't exist, the JSON file with the same name but a .json extension is
+    read instead. Weights from binary files are a read-only memory-mapped float32 array
+    if mmap is true, and a list for JSON files.
+    '''
+    path = model_file(filename)
+    if path is None:
+        raise IOError("No model file %s" % filename)
+
+    if not is_binary_model(path):
+        fp = open(path, 'r')
+        data = json.load(fp)
+        fp.close()
+        return (FeatureExtractor(data['features']), data['weights'])
+
+    fp = open(path, 'rb')
+    magic, version, header_len = PREFIX.unpack(fp.read(PREFIX.size))
+    if version > VERSION:
+        fp.close()
+        raise ModelFormatError("%s has model format version %d, newer than %d" % (path, version, VERSION))
+    header = json.loads(fp.read(header_len))
+    offset = PREFIX.size + header_len
+    num_weights = header['num_weights']
+    if os.path.getsize(path) < offset + num_weights * WEIGHT_DTYPE.itemsize:
+        fp.close()
+        raise ModelFormatError("%s is truncated" % path)
+
+    if mmap and num_weights > 0:
+        fp.close()
+        weights = np.memmap(path, dtype=WEIGHT_DTYPE, mode='r', offset=offset, shape=(num_weights,))
+    else:
+        weights = np.fromstring(fp.read(num_weights * WEIGHT_DTYPE.itemsize), dtype=WEIGHT_DTYPE)
+        fp.close()
+    return (FeatureExtractor(header['features']), weights)
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 2:
+        print "Usage: %s model.json [model.json ...]" % sys.argv[0]
+        sys.exit(1)
+
+    for filename in sys.argv[1:]:
+        features, weights = load_model(filename)
+        out = os.path.splitext(filename)[0] + '.bin'
+        save_model(out, features, weights)
+        print "%s -> %s (%d weights)" % (filename, out, len(weights))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# A point-to-point pathfinding service for AntWorld. Paths are found
+# with A* search on the wrap-around map, using the toroidal manhattan
+# distance as an (admissible) heuristic.
+#
+# Because most routes are requested over and over again by the same
+# ants as they walk towards a target, every path found is cached. Any
+# location along a cached path can reuse the remainder of that path
+# to the same goal. A cached path is only thrown away when water that
+# was revealed after the path was computed lands on top of it; since
+# unseen squares are optimistically treated as land, this is the only
+# way a cached path can become invalid.
+#
+# Searches are limited by a per-turn time budget, so that a bot can
+# issue hundreds of route requests each turn without timing out. Once
+# the budget is exhausted, only cached paths are returned.
+
+import heapq
+import time
+
+class PathFinder(object):
+    '''A* pathfinding with a path cache and a per-turn time budget.
+
+    Paths are returned as a list of locations starting with the first
+    step away from the start location and ending at the goal.'''
+
+    # Check the clock after this many node expansions.
+    check_interval = 64
+
+    def __init__(self, world, water, aim, budget_fraction=0.25, max_cache_paths=5000):
+        '''Create a pathfinder for the given world, whose map marks water squares with the 
+        value water, and whose directions are converted into X-Y vectors by the dict aim. 
+        Each turn, searches may use up to budget_fraction of the turn time.'''
+        self.world = world
+        self.water = water
+        self.moves = [(d, aim[d]) for d in sorted(aim) if aim[d] != (0, 0)]
+        self.budget_fraction = budget_fraction
+        self.max_cache_paths = max_cache_paths
+        self.turn_start = time.time()
+
+        self.clear()
+
+    def clear(self):
+        '''Throw away all cached paths.'''
+
+        # (loc, goal) -> (path id, index of loc on the path)
+        self.cache = {}
+        # path id -> (path, goal)
+        self.paths = {}
+        # loc -> set of path ids passing through loc
+        self.cell_paths = {}
+        self.next_path_id = 0
+
+        # Statistics, reset every turn.
+        self.searches = 0
+        self.cache_hits = 0
+        self.expanded = 0
+
+    def new_turn(self):
+        '''Reset the time budget and statistics for a new turn.'''
+        self.turn_start = time.time()
+        self.searches = 0
+        self.cache_hits = 0
+        self.expanded = 0
+
+    def budget(self):
+        '''Search time budget for a single turn, in seconds.'''
+        turntime = getattr(self.world, 'turntime', 1000)
+        return self.budget_fraction * turntime / 1000.0
+
+    def out_of_time(self):
+        return time.time() - self.turn_start > self.budget()
+
+    def invalidate(self, water_locs):
+        '''Remove every cached path that passes through one of the given newly revealed water locations.'''
+        for loc in water_locs:
+            path_ids = self.cell_paths.pop(loc, None)
+            if path_ids is None:
+                continue
+            for path_id in list(path_ids):
+                self._remove_path(path_id)
+
+    def find_path(self, start, goal):
+        '''Get a list of locations leading from start to goal, or None if the goal can't be reached (or the time budget is exhausted).'''
+        if start == goal:
+            return []
+
+        entry = self.cache.get((start, goal))
+        if entry is not None:
+            self.cache_hits += 1
+            path_id, index = entry
+            return list(self.paths[path_id][0][index+1:])
+
+        if self.out_of_time():
+            return None
+
+        path = self._search(start, goal)
+        if path is not None:
+            self._add_path(start, path, goal)
+        return path
+
+    def path_direction(self, start, goal):
+        '''Get the first direction along the path from start to goal, or None.'''
+        path = self.find_path(start, goal)
+        if not path:
+            return None
+        return self.direction(start, path[0])
+
+    def direction(self, loc, next_loc):
+        '''Direction that moves from loc to the adjacent location next_loc.'''
+        for d, (d_row, d_col) in self.moves:
+            if ((loc[0] + d_row) % self.world.height, (loc[1] + d_col) % self.world.width) == next_loc:
+                return d
+        return None
+
+    def _search(self, start, goal):
+        '''A* search on the wrap-around map.'''
+        world = self.world
+        height = world.height
+        width = world.width
+        game_map = world.map
+        water = self.water
+        moves = self.moves
+        goal_row, goal_col = goal
+        half_height = height / 2
+        half_width = width / 2
+
+        def heuristic(row, col):
+            d_row = abs(row - goal_row)
+            if d_row > half_height:
+                d_row = height - d_row
+            d_col = abs(col - goal_col)
+            if d_col > half_width:
+                d_col = width - d_col
+            return d_row + d_col
+
+        self.searches += 1
+        came_from = {start: None}
+        cost = {start: 0}
+        frontier = [(heuristic(start[0], start[1]), 0, start)]
+        expanded = 0
+
+        while frontier:
+            f, g, loc = heapq.heappop(frontier)
+            if loc == goal:
+                break
+            if g > cost[loc]:
+                continue
+
+            expanded += 1
+            if expanded % PathFinder.check_interval == 0 and self.out_of_time():
+                self.expanded += expanded
+                return None
+
+            row, col = loc
+            for d, (d_row, d_col) in moves:
+                n_row = (row + d_row) % height
+                n_col = (col + d_col) % width
+                if game_map[n_row][n_col] == water:
+                    continue
+                n_loc = (n_row, n_col)
+                n_g = g + 1
+                if n_loc not in cost or n_g < cost[n_loc]:
+                    cost[n_loc] = n_g
+                    came_from[n_loc] = loc
+                    heapq.heappush(frontier, (n_g + heuristic(n_row, n_col), n_g, n_loc))
+
+        self.expanded += expanded
+        if goal not in came_from:
+            return None
+
+        # Walk back from the goal to build the path.
+        path = []
+        loc = goal
+        while loc != start:
+            path.append(loc)
+            loc = came_from[loc]
+        path.reverse()
+        return path
+
+    def _add_path(self, start, path, goal):
+        '''Add a path to the cache so that every location along it can reuse it.'''
+        if len(self.paths) >= self.max_cache_paths:
+            self.clear()
+
+        path_id = self.next_path_id
+        self.next_path_id += 1
+
+        full_path = tuple([start] + path)
+        self.paths[path_id] = (full_path, goal)
+        for index, loc in enumerate(full_path):
+            if loc != goal:
+                self.cache[(loc, goal)] = (path_id, index)
+            self.cell_paths.setdefault(loc, set()).add(path_id)
+
+    def _remove_path(self, path_id):
+        full_path, goal = self.paths.pop(path_id)
+        for loc in full_path:
+            entry = self.cache.get((loc, goal))
+            if entry is not None and entry[0] == path_id:
+                del self.cache[(loc, goal)]
+            path_ids = self.cell_paths.get(loc)
+            if path_ids is not None:
+                path_ids.discard(path_id)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# A persistent store of tournament game results.
+#
+# Every game played by BatchLocalEngine.RunTournament() can be appended
+# to a ResultStore, one JSON record per line, as soon as it finishes. A
+# record holds the map and engine seeds, the identities of the two bots
+# (their class, plus a hash of the features and weights of bots that
+# have them), the scores, the number of turns, and timings.
+#
+# When the file is opened again, its records are indexed by game, so a
+# tournament with the same seed can resume where an interrupted run
+# stopped: games that are already in the store are not played again,
+# and their stored results are used instead. Lines are appended in a
+# single write, so several processes running shards of a job can share
+# one file.
+
+import hashlib
+import json
+import os
+from fractions import Fraction
+
+def bot_id(bot):
+    '''Identity of a bot for the result store: its class name, plus a hash of its
+    features and weights if it has them (e.g. ValueBot).'''
+    name = bot.__class__.__name__
+    features = getattr(bot, 'features', None)
+    weights = getattr(bot, 'weights', None)
+    if features is None or weights is None:
+        return name
+
+    data = json.dumps({'features': features.to_dict(),
+                       'weights': [float(w) for w in weights]}, sort_keys=True)
+    return "%s-%s" % (name, hashlib.sha1(data).hexdigest()[:16])
+
+class ResultStore(object):
+    '''Append-only JSON lines file of game results, indexed by game.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = {}
+        if os.path.exists(filename):
+            fp = open(filename, 'r')
+            for line in fp:
+                line = line.strip()
+                # The last line may be incomplete if a run was interrupted.
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.index[self.record_key(record)] = record
+            fp.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def key(self, map_seed, engine_seed, map_dims, turns, cutoff, a_id, b_id):
+        '''Key identifying a game: the same seeds, map size range, turn limit and early cutoff 
+        rule (a (cutoff_turn, cutoff_percent) pair), and the same bots.'''
+        return (map_seed, engine_seed, tuple(map_dims), turns, tuple(cutoff), a_id, b_id)
+
+    def record_key(self, record):
+        # Records from before games could be cut off early have no cutoff, and match no game.
+        return self.key(record['map_seed'], record['engine_seed'], record['map_dims'],
+                        record['max_turns'], record.get('cutoff', ()), record['bots'][0], record['bots'][1])
+
+    def get(self, key):
+        '''Get the stored record of a game, or None.'''
+        return self.index.get(key)
+
+    def scores(self, record):
+        '''Scores of a record, as Fractions like the engine's.'''
+        return [Fraction(s) for s in record['scores']]
+
+    def add(self, map_seed, engine_seed, map_dims, max_turns, cutoff, bot_ids, scores, turns, time, bot_time):
+        '''Append the result of a game to the store and return its record.'''
+        record = {'map_seed': map_seed,
+                  'engine_seed': engine_seed,
+                  'map_dims': list(map_dims),
+                  'max_turns': max_turns,
+                  'cutoff': list(cutoff),
+                  'bots': list(bot_ids),
+                  'scores': [str(s) for s in scores],
+                  'turns': turns,
+                  'time': time,
+                  'bot_time': bot_time}
+
+        fp = open(self.filename, 'a')
+        fp.write(json.dumps(record, sort_keys=True) + '\n')
+        fp.close()
+
+        self.index[self.record_key(record)] = record
+        return record
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Sequential early stopping for tournaments between two teams of bots.
+#
+# Instead of playing a fixed number of games for every matchup, each
+# matchup is treated as Wald's sequential probability ratio test (SPRT)
+# of "team A wins with probability 1/2 - delta" against "team A wins
+# with probability 1/2 + delta". After every game, the log likelihood
+# ratio of the results so far is compared to two thresholds, and the
+# matchup stops as soon as either hypothesis is accepted. Matchups that
+# one bot dominates are therefore decided after a handful of games (3
+# straight wins or losses with the defaults), and the games that are
+# saved can be spent on the close contests instead.
+#
+# The SPRT accepts the wrong hypothesis with probability at most
+# 1 - confidence when the true win rate is 1/2 -/+ delta or further from
+# 1/2; matchups closer than that are simply played until max_games.
+
+import math
+
+# Outcomes of a matchup.
+UNDECIDED = 0
+A_WINS = 1
+B_WINS = 2
+
+class SequentialTest(object):
+    '''Decides which matchups of a tournament are still worth playing.'''
+
+    def __init__(self, num_a, num_b, confidence=0.95, delta=0.25, min_games=1, max_games=30):
+        '''Test num_a team A bots against num_b team B bots. Matchups are played at least
+        min_games and at most max_games times.'''
+        self.min_games = min_games
+        self.max_games = max_games
+
+        # Log likelihood ratio of a win and a loss for team A, and the acceptance thresholds.
+        error = 1.0 - confidence
+        self.win_llr = math.log((0.5 + delta) / (0.5 - delta))
+        self.loss_llr = -self.win_llr
+        self.upper = math.log((1.0 - error) / error)
+        self.lower = -self.upper
+
+        self.llr = {}
+        self.games = {}
+        self.outcome = {}
+        for a in range(num_a):
+            for b in range(num_b):
+                self.llr[(a, b)] = 0.0
+                self.games[(a, b)] = 0
+                self.outcome[(a, b)] = UNDECIDED
+
+    def is_active(self, a, b):
+        '''Whether the matchup between team A bot a and team B bot b should still be played.'''
+        key = (a, b)
+        return self.outcome[key] == UNDECIDED and self.games[key] < self.max_games
+
+    def done(self):
+        return not any(self.is_active(a, b) for (a, b) in self.games)
+
+    def remaining_games(self):
+        '''Most games that the active matchups may still play.'''
+        return sum(self.max_games - self.games[key] for key in self.games if self.is_active(*key))
+
+    def record(self, a, b, a_won):
+        '''Record the result of a game between team A bot a and team B bot b.'''
+        key = (a, b)
+        self.games[key] += 1
+        if a_won:
+            self.llr[key] += self.win_llr
+        else:
+            self.llr[key] += self.loss_llr
+
+        if self.games[key] >= self.min_games:
+            if self.llr[key] >= self.upper:
+                self.outcome[key] = A_WINS
+            elif self.llr[key] <= self.lower:
+                self.outcome[key] = B_WINS
@@ -4,19 +4,21 @@ Created on Oct 1, 2011
 @author: djweiss
 '''
 import math
+import numpy as np
 import worldstate
 
 class GridLookup:     
-    """ Datastructure that, once created, allows the lookup of nearby points to query point in constant time.
+    """ Spatial hash that, once created, allows the lookup of nearby points to a query point in constant time.
     
-    The GridLookup works as follows: it divides the map into a grid of size <lookup_res> cells.
+    The GridLookup divides the map into square buckets of size <resolution>. When the map 
+    dimensions are not multiples of <resolution>, the last row and column of buckets are 
+    smaller, so that bucket math is exact on the wrap-around map. Each point is stored in 
+    exactly one bucket.
     
-    For all input points, it computes the grid location of the 9 grid cells that either contain 
-    the given point or are adjacent, allowing for wrap-around in the infinite wrap-around map.
-    
-    Thus, each grid cell is a bucket in a dictionary containing points that are within one grid cell 
-    adjacent to the lookup cell. Thus, we can build this data structure in constant time,
-    and lookup nearby points within 2*<lookup_res> manhattan distance of the query point.
+    Queries look at the buckets overlapping a window around the query point, allowing for 
+    wrap-around: nearby_points() returns the points in the 3x3 buckets around the query point,
+    within() returns all points within a squared euclidean distance, and nearest() returns the 
+    k nearest points in manhattan distance.
 
     """
     
@@ -29,15 +31,152 @@ class GridLookup:
         self.width = width
         self.lookup_res = resolution
         
-        # Compute grid dimensions
+        # Compute grid dimensions, including partial buckets at the edges.
+        self.grid_width = (self.width + resolution - 1) // resolution
+        self.grid_height = (self.height + resolution - 1) // resolution
+        
+        self.grid = {}
+        self.size = 0
+        for point in points:
+            self.add(point)
+
+    def _key(self, point):
+        """Bucket containing a point."""
+        return ((point[0] % self.height) // self.lookup_res, 
+                (point[1] % self.width) // self.lookup_res)
+
+    def add(self, point):
+        """Insert a point into its bucket."""
+        key = self._key(point)
+        bucket = self.grid.get(key)
+        if bucket is None:
+            self.grid[key] = [point]
+        else:
+            bucket.append(point)
+        self.size += 1
+
+    def remove(self, point):
+        """Remove a point from its bucket, if present."""
+        key = self._key(point)
+        bucket = self.grid.get(key)
+        if bucket is not None and point in bucket:
+            bucket.remove(point)
+            if not bucket:
+                del self.grid[key]
+            self.size -= 1
+
+    def update(self, added, removed):
+        """Apply a list of removed and added points."""
+        for point in removed:
+            self.remove(point)
+        for point in added:
+            self.add(point)
+
+    def _bucket_span(self, center, radius, size, grid_size):
+        """Bucket indices overlapping the wrapped interval [center-radius, center+radius] along one axis."""
+        if 2*radius + 1 >= size:
+            return range(grid_size)
+        
+        res = self.lookup_res
+        span = []
+        pos = center - radius
+        end = center + radius
+        while pos <= end:
+            wrapped = pos % size
+            b = wrapped // res
+            if b not in span:
+                span.append(b)
+            # Jump to the first position of the next bucket.
+            pos += min((b + 1)*res, size) - wrapped
+        return span
+
+    def _points_in_window(self, point, radius):
+        """All points in buckets overlapping the square window of the given radius around point."""
+        rows = self._bucket_span(point[0], radius, self.height, self.grid_height)
+        cols = self._bucket_span(point[1], radius, self.width, self.grid_width)
+        found = []
+        grid = self.grid
+        for r in rows:
+            for c in cols:
+                bucket = grid.get((r, c))
+                if bucket is not None:
+                    found.extend(bucket)
+        return found
+
+    def _deltas(self, p1, p2):
+        d_row = abs(p1[0] - p2[0]) % self.height
+        d_row = min(d_row, self.height - d_row)
+        d_col = abs(p1[1] - p2[1]) % self.width
+        d_col = min(d_col, self.width - d_col)
+        return d_row, d_col
+
+    def nearby_points(self, point):
+        """Lookup points in the 3x3 buckets around the query point."""
+        
+        row, col = self._key(point)
+        rows = set([(row + d) % self.grid_height for d in (-1, 0, 1)])
+        cols = set([(col + d) % self.grid_width for d in (-1, 0, 1)])
+        found = []
+        grid = self.grid
+        for r in rows:
+            for c in cols:
+                bucket = grid.get((r, c))
+                if bucket is not None:
+                    found.extend(bucket)
+        return found
+
+    def within(self, point, r2):
+        """Lookup all points within squared euclidean distance r2 of the query point."""
+        
+        radius = int(math.sqrt(r2))
+        found = []
+        for p in self._points_in_window(point, radius):
+            d_row, d_col = self._deltas(point, p)
+            if d_row*d_row + d_col*d_col <= r2:
+                found.append(p)
+        return found
+
+    def nearest(self, point, k=1):
+        """Lookup the k points nearest to the query point in manhattan distance, sorted by
+        increasing distance. Returns fewer than k points if there are fewer than k stored."""
+        
+        k = min(k, self.size)
+        if k <= 0:
+            return []
+        
+        # Grow the search window one bucket at a time. Every point within manhattan distance
+        # <radius> lies inside the window, so we can stop once k points are that close.
+        max_radius = self.height/2 + self.width/2
+        radius = self.lookup_res
+        while True:
+            dists = []
+            for p in self._points_in_window(point, radius):
+                d_row, d_col = self._deltas(point, p)
+                dists.append((d_row + d_col, p))
+            dists.sort(key=lambda x: x[0])
+            if (len(dists) >= k and dists[k-1][0] <= radius) or radius >= max_radius:
+                return [p for d, p in dists[:k]]
+            radius += self.lookup_res
+
+class LegacyGridLookup:
+    """The original 9-bucket GridLookup, kept as a reference for benchmarking (see __main__).
+
+    It stores each point in the 9 buckets around it and only answers "within about 
+    2*resolution" queries. Its bucket math is off when the map dimensions are not 
+    multiples of the resolution.
+    """
+    
+    def __init__(self, points, height, width, resolution):
+        self.height = height
+        self.width = width
+        self.lookup_res = resolution
+        
         self.grid_width = math.floor(self.width/resolution)
         self.grid_height = math.floor(self.height/resolution)
         
         self.grid = {}
         
         for row,col in points:
-
-            # Compute grid coordinates            
             g_row = int(row/resolution)
             g_col = int(col/resolution)
             
@@ -62,8 +201,6 @@ class GridLookup:
                         self.grid[key] = [(row,col)]  
 
     def nearby_points(self, point):
-        """Lookup points within 2*lookup_res manhattan distance of query point."""
-        
         g_row = int(point[0]/self.lookup_res)
         g_col = int(point[1]/self.lookup_res)
         if self.grid.has_key( (g_row,g_col) ):
@@ -77,87 +214,158 @@ class GlobalState:
     Feel free to modify this class as you see fit for HW3. Keep in mind that ValueBot instantiates GlobalState from
     the world, so you may need to change the ValueBot.do_turn() method if you change this state significantly.
     
-    By default, this GlobalState class does not create lookup tables unless there are at least 25 points of interest (enemies,
-    food, or friendly ants.) 
+    The lookup tables for enemies, food and friendly ants are kept between turns and updated from the changes
+    reported by AntWorld (see AntWorld._record_changes()), so that their cost only depends on how much moved. They are 
+    rebuilt from scratch only when a turn was missed.
     
     This GlobalState class also implements, as an example of another useful thing to keep track of, how many times positions
-    on the map have been visited, at a coarse resolution than individual squares. It demonstrates how to use the new RenderHeatMap()
-    method of LocalEngine which is useful to give a visual representation of map data for debugging purposes in the update() method.
+    on the map have been visited, at a coarse resolution than individual squares. The counts are kept in a small NumPy array
+    and can optionally decay exponentially, so that old visits matter less (visited_decay < 1). It demonstrates how to use 
+    the new RenderHeatMap() method of LocalEngine which is useful to give a visual representation of map data for debugging 
+    purposes in the update() method. Since rendering is slow, the heatmap is only drawn every heatmap_interval turns, or on 
+    demand with render_heatmap().
     """    
     
-    cutoff = 25   # When to use the lookup table, and when not.
+    lookup_class = GridLookup   # Spatial hash used for the lookup tables.
         
-    def __init__(self, world, resolution, visited_cells=10, draw_heatmap=True): 
+    def __init__(self, world, resolution, visited_cells=10, draw_heatmap=True, visited_decay=1.0, heatmap_interval=10): 
         self.world = world
         self.lookup_res = resolution
-        self.visited_res = int(min(self.world.height/visited_cells, self.world.width/visited_cells))
-        self.visited = {}
+        self.visited_res = max(1, int(min(self.world.height/visited_cells, self.world.width/visited_cells)))
+        self.visited = np.zeros(((self.world.height + self.visited_res - 1) // self.visited_res,
+                                 (self.world.width + self.visited_res - 1) // self.visited_res))
+        self.visited_decay = visited_decay
+
+        self.draw_heatmap = draw_heatmap
+        self.heatmap_interval = heatmap_interval
 
-        self.draw_heatmap = True
+        # Turn at which the lookup tables were last brought up to date.
+        self.turn = None
                 
         self.update()
+
+    def _rebuild_lookups(self):
+        """Build the lookup tables from scratch."""
+        world = self.world
+        self.grid_enemy = self.lookup_class(world.enemies, world.height, world.width, self.lookup_res)
+        self.grid_food = self.lookup_class(world.food, world.height, world.width, self.lookup_res)
+        self.grid_friendly = self.lookup_class(self.friendly_locs, world.height, world.width, self.lookup_res)
         
     def update(self):
         world = self.world
         
-        # Parse all possible points of interest
-        if len(world.enemies) > GlobalState.cutoff:
-            self.grid_enemy = GridLookup(world.enemies, world.height, world.width, self.lookup_res)
-        else:
-            self.grid_enemy = None
-                 
-        if len(world.food) > GlobalState.cutoff:             
-            self.grid_food = GridLookup(world.food, world.height, world.width, self.lookup_res)
-        else:
-            self.grid_food = None
+        if self.turn == world.turn:
+            return
         
-        if len(world.ants) > GlobalState.cutoff:
-            ant_locs = [ant.location for ant in self.world.ants] 
-            self.grid_friendly = GridLookup(ant_locs, world.height, world.width, self.lookup_res)
+        # Friendly locations for this turn, and lookup results and feature primitives shared by all queries this turn.
+        self.friendly_locs = tuple(world._alive_locations())
+        self.lookup_cache = {}
+        self.primitive_cache = {}
+        
+        # Bring the lookup tables up to date with this turn's changes. Lookup classes that can't be
+        # updated in place are rebuilt.
+        if self.turn == world.turn - 1 and hasattr(self.lookup_class, 'update'):
+            self.grid_enemy.update(*world.changes['enemies'])
+            self.grid_food.update(*world.changes['food'])
+            self.grid_friendly.update(*world.changes['ants'])
         else:
-            self.grid_friendly = None
+            self._rebuild_lookups()
+        self.turn = world.turn
             
         # Update visited states
-        for ant in self.world.ants:
-            key = self._visited_key(ant.location)
-            if self.visited.has_key(key):
-                self.visited[key] += 1
-            else:
-                self.visited[key] = 1
+        if self.visited_decay != 1.0:
+            self.visited *= self.visited_decay
+        if self.friendly_locs:
+            locs = np.array(self.friendly_locs, dtype=int)
+            np.add.at(self.visited, (locs[:, 0] // self.visited_res, locs[:, 1] // self.visited_res), 1)
                 
+        if self.draw_heatmap and self.heatmap_interval and world.turn % self.heatmap_interval == 0:
+            self.render_heatmap()
+
+    def render_heatmap(self):
+        """Draw the visited heatmap, if running under the LocalEngine."""
+        
         # This is very important: do not import localengine at top of python file or else your code will
         # not be able to run on the competition server. 
         if self.world.engine is not None:
             from src.localengine import LocalEngine
-            if self.world.engine.__class__ == LocalEngine and self.draw_heatmap:
-                heatmap = [ [self.get_visited((row,col)) for col in range(0, self.world.width)] for row in range(0,self.world.height)]
-                self.world.engine.RenderHeatMap(heatmap, window="Visited", minval=0, maxval=5)
+            if self.world.engine.__class__ == LocalEngine:
+                self.world.engine.RenderHeatMap(self.visited_map(), window="Visited", minval=0, maxval=5)
+
+    def _lookup(self, name, grid, loc):
+        """Points in the buckets around loc, or the nearest point if those are all empty (or only contain loc).
+        
+        Results are cached for the rest of the turn and shared between callers, so they are returned as tuples.
+        """
+        
+        key = (name, grid._key(loc))
+        points = self.lookup_cache.get(key)
+        if points is None:
+            points = tuple(grid.nearby_points(loc))
+            self.lookup_cache[key] = points
+        if len(points) > 1 or (len(points) == 1 and points[0] != loc):
+            return points
+        return tuple(p for p in grid.nearest(loc, 2) if p != loc)[:1]
         
     def lookup_nearby_food(self, loc):
-        """Returns food within 2*lookup_res manhattan distance if n > 25, otherwise all food."""
+        """Returns food in the lookup cells around loc, or the nearest food if there is none nearby."""
         
-        if self.grid_food is None:
-            return self.world.food
-
-        return self.grid_food.nearby_points(loc)
+        return self._lookup('food', self.grid_food, loc)
 
     def lookup_nearby_friendly(self, loc):
-        """Returns friendlies within 2*lookup_res manhattan distance if n > 25, otherwise all friends."""
+        """Returns friendlies in the lookup cells around loc, or the nearest friendly if there is none nearby.
         
-        ant_locs = [ant.location for ant in self.world.ants if ant.location != loc]
-        if self.grid_friendly is None:
-            return ant_locs
-
-        # remove the query point from the lookup        
-        return self.grid_friendly.nearby_points(loc)
+        The result is shared by all queries in the same lookup cell, so it may include loc itself;
+        use exclude_self=True with AntWorld.closest_location() to skip it.
+        """
+        
+        return self._lookup('friendly', self.grid_friendly, loc)
 
     def lookup_nearby_enemy(self, loc):
-        """Returns enemies within 2*lookup_res manhattan distance if n > 25, otherwise all enemies."""
+        """Returns enemies in the lookup cells around loc, or the nearest enemy if there is none nearby."""
         
-        if self.grid_enemy is None:
-            return self.world.enemies
+        return self._lookup('enemy', self.grid_enemy, loc)
+
+    # Feature primitives. These are memoized per turn by location, so that feature extractors (and every 
+    # sub-extractor of a composite extractor) can call them as often as they like.
+
+    def _closest(self, name, grid, loc, exclude_self=False):
+        """Nearest point of grid to loc, other than loc itself if exclude_self is set, or None.
+        
+        Unlike the lookups above, this searches beyond the buckets around loc until the nearest 
+        point is certain, so it agrees with AntWorld.closest_location() up to ties.
+        """
+        
+        key = (name, loc)
+        if key not in self.primitive_cache:
+            points = grid.nearest(loc, 2 if exclude_self else 1)
+            if exclude_self:
+                points = [p for p in points if p != loc]
+            self.primitive_cache[key] = points[0] if points else None
+        return self.primitive_cache[key]
+
+    def closest_enemy(self, loc):
+        """Closest enemy to loc, or None."""
         
-        return self.grid_enemy.nearby_points(loc)
+        return self._closest('enemy', self.grid_enemy, loc)
+
+    def closest_food(self, loc):
+        """Closest food to loc, or None."""
+        
+        return self._closest('food', self.grid_food, loc)
+
+    def closest_friend(self, loc):
+        """Closest friendly ant to loc, other than one on loc itself, or None."""
+        
+        return self._closest('friend', self.grid_friendly, loc, exclude_self=True)
+
+    def next_position(self, loc, action):
+        """Location reached from loc by taking action."""
+        
+        key = ('next', loc, action)
+        if key not in self.primitive_cache:
+            self.primitive_cache[key] = self.world.next_position(loc, action)
+        return self.primitive_cache[key]
 
     def _visited_key(self, loc):
         """Get the coarse resolution location for keeping track of visited positions."""
@@ -177,11 +385,86 @@ class GlobalState:
         return self.get_visited(next_loc)
 
     def get_visited(self, loc):
-        """Returns the number of times this location has been visited.""" 
+        """Returns the number of times this location has been visited (decayed, if visited_decay < 1).""" 
         
-        key = self._visited_key(loc)
-        if self.visited.has_key(key):
-            return self.visited[key]
-        else:
-            return 0
+        return self.visited[self._visited_key(loc)]
+
+    def visited_map(self):
+        """Returns the visited counts upsampled to a full height x width array."""
+        
+        res = self.visited_res
+        full = np.repeat(np.repeat(self.visited, res, axis=0), res, axis=1)
+        return full[:self.world.height, :self.world.width]
+
+if __name__ == '__main__':
+    # Benchmark GlobalState.update() and lookups with GridLookup (updated incrementally) vs. 
+    # LegacyGridLookup (rebuilt every turn), on a world where every ant moves each turn.
+    import random
+    import time
+    
+    rows, cols, n, turns = 200, 203, 1000, 20
+    def random_loc():
+        return (random.randrange(rows), random.randrange(cols))
+    
+    for lookup_class in (LegacyGridLookup, GridLookup):
+        random.seed(0)
+        world = worldstate.AntWorld()
+        world.L.setLevel(50)
+        world.stateless = True
+        world._setup_parameters("rows %d\ncols %d" % (rows, cols))
+        ant_locs = list(set(random_loc() for i in range(n)))
+        food = [random_loc() for i in range(n)]
+        enemies = [random_loc() for i in range(n)]
+        
+        GlobalState.lookup_class = lookup_class
+        state = None
+        update_time = lookup_time = 0
+        for turn in range(turns):
+            ant_locs = list(set(((r + random.choice((-1, 0, 1))) % rows, c) for r, c in ant_locs))
+            msg = '\n'.join(['a %d %d 0' % loc for loc in ant_locs] + 
+                            ['f %d %d' % loc for loc in food] + 
+                            ['a %d %d 1' % loc for loc in enemies if loc not in ant_locs])
+            world._update(msg)
+            
+            start = time.time()
+            if state is None:
+                state = GlobalState(world, resolution=10)
+            else:
+                state.update()
+            update_time += time.time() - start
+        
+            start = time.time()
+            for loc in ant_locs:
+                state.grid_food.nearby_points(loc)
+                state.grid_enemy.nearby_points(loc)
+                state.grid_friendly.nearby_points(loc)
+            lookup_time += time.time() - start
+        
+        print "%s: update() = %.2f ms, %d lookups = %.2f ms per turn" % (lookup_class.__name__, update_time*1000/turns, 3*len(ant_locs), lookup_time*1000/turns)
     
+    # Check the closest-target primitives against AntWorld on sparse worlds, where most targets
+    # are outside the buckets around an ant.
+    GlobalState.lookup_class = GridLookup
+    rows, cols = 60, 60
+    farther = lookups = 0
+    for trial in range(100):
+        world = worldstate.AntWorld()
+        world.L.setLevel(50)
+        world.stateless = True
+        world._setup_parameters("rows %d\ncols %d" % (rows, cols))
+        ant_locs = list(set(random_loc() for i in range(15)))
+        enemies = [loc for loc in set(random_loc() for i in range(8)) if loc not in ant_locs]
+        msg = '\n'.join(['a %d %d 0' % loc for loc in ant_locs] + 
+                        ['f %d %d' % random_loc() for i in range(8)] + 
+                        ['a %d %d 1' % loc for loc in enemies])
+        world._update(msg)
+        state = GlobalState(world, resolution=10, draw_heatmap=False)
+        for loc in ant_locs:
+            for found, expected in ((state.closest_enemy(loc), world.closest_enemy(loc)),
+                                    (state.closest_food(loc), world.closest_food(loc)),
+                                    (state.closest_friend(loc), world.closest_friend(loc))):
+                lookups += 1
+                if (found is None) != (expected is None) or (found is not None and 
+                        world.distance(loc, found) > world.distance(loc, expected)):
+                    farther += 1
+    print "%d of %d closest-target lookups found a target farther than AntWorld's" % (farther, lookups)
@@ -17,14 +17,20 @@
 # simplify common operations, such as computing distances, finding
 # targets, etc.
 #
-# TODO: AntsWorld should keep track of UNSEEN map elements, which are
-# currently unused.
+# AntWorld also keeps a persistent memory of the map: the last turn
+# each square was seen, food and enemy sightings that have since left
+# vision, and the frontier of seen squares bordering unseen ones. This
+# memory is updated incrementally from the view radius of our ants.
 
 import random
 import sys
 import traceback
 
+import numpy as np
+
 from logutil import *
+from assignment import auction_assignment
+from pathfinding import PathFinder
 
 # Constants used to interpret mapdata. TODO: A more elegant solution.
 MY_ANT = 0
@@ -99,6 +105,10 @@ class AntWorld(object):
         self.width = None
         self.height = None
         self.map = None
+        self.turn = 0
+        self.turntime = 1000
+        self.loadtime = 3000
+        self.viewradius2 = 55
         
         # Lookup tables for enemies, friendly ants, and food.
         self.enemy_dict = {}
@@ -107,6 +117,16 @@ class AntWorld(object):
         self.ant_lookup = {}
         self.ants = []
 
+        # Persistent map memory (see _update_memory()).
+        self.last_seen = None
+        self.visible = None
+        self.food_memory = {}
+        self.enemy_memory = {}
+        self.frontier = set()
+
+        # Locations that changed during the last update (see _record_changes()).
+        self.changes = {'ants': ([], []), 'food': ([], []), 'enemies': ([], [])}
+
         # Default logger is the global logger (see logutil.py).
         self.L = L
         self.engine = engine
@@ -114,6 +134,9 @@ class AntWorld(object):
         self.stateless = False
         self.debug_mode = False
 
+        # Cached A* pathfinding, see pathfinding.py.
+        self.pathfinder = PathFinder(self, WATER, AIM)
+
     def _setup_parameters(self, data):
         '''Parse raw data to determine game settings.'''
         for line in data.split('\n'):
@@ -142,6 +165,26 @@ class AntWorld(object):
                 elif key == 'spawnradius2':
                     self.spawnradius2 = int(tokens[1])
 
+        # Cached paths from a previous game are no longer valid.
+        self.pathfinder.clear()
+
+        # Reset map memory. A last_seen value of -1 means never seen.
+        self.turn = 0
+        self.last_seen = np.empty((self.height, self.width), dtype=np.int32)
+        self.last_seen.fill(-1)
+        self.visible = np.zeros((self.height, self.width), dtype=bool)
+        self.food_memory = {}
+        self.enemy_memory = {}
+        self.frontier = set()
+
+        # Offsets of all squares within the view radius of an ant.
+        radius = int(self.viewradius2 ** 0.5)
+        offsets = [(d_row, d_col) 
+                   for d_row in range(-radius, radius+1)
+                   for d_col in range(-radius, radius+1)
+                   if d_row**2 + d_col**2 <= self.viewradius2]
+        self.view_offsets = np.array(offsets, dtype=int)
+
         # Initialize all land map.
         self.map = [[LAND for col in range(self.width)]
                                 for row in range(self.height)]
@@ -157,6 +200,13 @@ class AntWorld(object):
         if self.debug_mode:
             self.L.debug("Updating world state:")
 
+        self.turn += 1
+
+        # Remember last turn's points of interest so we can report what changed.
+        prev_ants = self._alive_locations()
+        prev_food = set(self.food)
+        prev_enemies = set(self.enemy_dict)
+
         # Clear map of last turn's friendly ants.
         for row, col in [ant.location for ant in self.ants]:
             self.map[row][col] = LAND
@@ -179,6 +229,9 @@ class AntWorld(object):
 
         if self.stateless:
             self.ants = []
+
+        # Water revealed this turn, used to invalidate cached paths.
+        new_water = []
         
         # Now parse the data.
         for line in data.split('\n'):
@@ -216,16 +269,97 @@ class AntWorld(object):
                         self.map[row][col] = FOOD
                         self.food.append((row, col))
                     elif tokens[0] == 'w': # water found
+                        if self.map[row][col] != WATER:
+                            new_water.append((row, col))
                         self.map[row][col] = WATER
                         if self.debug_mode:
                             self.L.debug("RCV WATER at %d,%d" % (row,col))
                     elif tokens[0] == 'd': # dead body found
-                        self.map[row][col] = DEAD
+                        # Food can spawn (and ants can move) onto a square where an ant
+                        # just died, so don't hide what else is there.
+                        if self.map[row][col] == LAND:
+                            self.map[row][col] = DEAD
                         self.dead_dict[(row,col)] = True
         
         if not self.stateless:
             self._track_friendlies(check_ants)
 
+        self._record_changes(prev_ants, prev_food, prev_enemies)
+        self._update_memory(new_water)
+
+        self.pathfinder.invalidate(new_water)
+        self.pathfinder.new_turn()
+
+    def _alive_locations(self):
+        return set(ant.location for ant in self.ants if ant.status == AntStatus.ALIVE)
+
+    def _record_changes(self, prev_ants, prev_food, prev_enemies):
+        '''Record which friendly ant, food and enemy locations appeared and disappeared this turn.
+
+        self.changes maps 'ants', 'food' and 'enemies' to (added, removed) lists of locations, 
+        so that persistent indexes (see state.py) can be updated without a rebuild. An ant
+        that moved shows up as removed from its old square and added on its new one.'''
+        ants = self._alive_locations()
+        food = set(self.food)
+        enemies = set(self.enemy_dict)
+        self.changes = {'ants': (list(ants - prev_ants), list(prev_ants - ants)),
+                        'food': (list(food - prev_food), list(prev_food - food)),
+                        'enemies': (list(enemies - prev_enemies), list(prev_enemies - enemies))}
+
+    def _update_memory(self, new_water):
+        '''Update the persistent map memory from what our ants can see this turn.'''
+        self.visible = np.zeros((self.height, self.width), dtype=bool)
+        ant_locs = [ant.location for ant in self.ants if ant.status == AntStatus.ALIVE]
+        if ant_locs:
+            # Stamp every square within view radius of an ant.
+            locs = np.array(ant_locs, dtype=int)
+            rows = (locs[:, 0, np.newaxis] + self.view_offsets[np.newaxis, :, 0]) % self.height
+            cols = (locs[:, 1, np.newaxis] + self.view_offsets[np.newaxis, :, 1]) % self.width
+            self.visible[rows, cols] = True
+
+        newly_seen = zip(*np.nonzero(self.visible & (self.last_seen < 0)))
+        self.last_seen[self.visible] = self.turn
+
+        # Forget sightings in plain view that are no longer there, then
+        # remember the current ones.
+        food_now = set(self.food)
+        for loc in self.food_memory.keys():
+            if self.visible[loc] and loc not in food_now:
+                del self.food_memory[loc]
+        for loc in self.food:
+            self.food_memory[loc] = self.turn
+
+        for loc in self.enemy_memory.keys():
+            if self.visible[loc] and loc not in self.enemy_dict:
+                del self.enemy_memory[loc]
+        for loc, owner in self.enemy_dict.items():
+            self.enemy_memory[loc] = (owner, self.turn)
+
+        # Only newly seen squares and their neighbors can enter or leave
+        # the explored frontier.
+        for loc in new_water:
+            self.frontier.discard(loc)
+        check = set()
+        for row, col in newly_seen:
+            loc = (int(row), int(col))
+            check.add(loc)
+            for d in ('n', 'e', 's', 'w'):
+                check.add(self.next_position(loc, d))
+        for loc in check:
+            if self._is_frontier(loc):
+                self.frontier.add(loc)
+            else:
+                self.frontier.discard(loc)
+
+    def _is_frontier(self, loc):
+        '''A frontier square is a seen, non-water square next to an unseen square.'''
+        if self.last_seen[loc] < 0 or self.map[loc[0]][loc[1]] == WATER:
+            return False
+        for d in ('n', 'e', 's', 'w'):
+            if self.last_seen[self.next_position(loc, d)] < 0:
+                return True
+        return False
+
     def _track_friendlies(self, check_ants):
         # Track friendly living ants.
         for ant in [a for a in self.ants 
@@ -337,6 +471,31 @@ class AntWorld(object):
     def enemies(self):
         return self.enemy_dict.keys()
 
+    def is_visible(self, loc):
+        '''True if loc is currently within view of one of our ants.'''
+        return bool(self.visible[loc[0] % self.height, loc[1] % self.width])
+
+    def is_unseen(self, loc):
+        '''True if loc has never been seen.'''
+        return self.last_seen[loc[0] % self.height, loc[1] % self.width] < 0
+
+    def turns_since_seen(self, loc):
+        '''Number of turns since loc was last seen, or None if it has never been seen.'''
+        last = self.last_seen[loc[0] % self.height, loc[1] % self.width]
+        if last < 0:
+            return None
+        return self.turn - int(last)
+
+    def remembered_food(self, max_age=None):
+        '''Get a list of (loc, age) pairs for all food seen and not known to be eaten, optionally only sightings at most max_age turns old.'''
+        return [(loc, self.turn - turn) for loc, turn in self.food_memory.items()
+                if max_age is None or self.turn - turn <= max_age]
+
+    def remembered_enemies(self, max_age=None):
+        '''Get a list of (loc, owner, age) tuples for enemy sightings, optionally only those at most max_age turns old.'''
+        return [(loc, owner, self.turn - turn) for loc, (owner, turn) in self.enemy_memory.items()
+                if max_age is None or self.turn - turn <= max_age]
+
     def passable(self, loc):
         return self.map[loc[0]][loc[1]] > WATER
     
@@ -344,6 +503,11 @@ class AntWorld(object):
         row,col = loc
         return self.map[row][col] in (LAND, DEAD)
 
+    def enterable(self, loc):
+        '''True if a friendly ant may be ordered onto loc: land that is empty or holds one of our own ants (which may move away). Water, food and enemy ants block.'''
+        row,col = loc
+        return self.map[row][col] in (LAND, DEAD, MY_ANT)
+
     def next_position(self, location, direction):
         '''Get the next position occupied by an ant moving in a specific direction. (Sphere world makes this non-trivial).'''
         row, col = location
@@ -398,13 +562,67 @@ class AntWorld(object):
         I don't like the ambiguous naming, but for backwards compatibility, keeping this"""
         return self.manhattan_distance(loc1,loc2)
 
+    def _wrapped_deltas(self, sources, targets):
+        '''Absolute row and column offsets between every source and every target on sphere world, as two len(sources) x len(targets) arrays.'''
+        sources = np.asarray(sources, dtype=int).reshape(-1, 2)
+        targets = np.asarray(targets, dtype=int).reshape(-1, 2)
+        d_row = np.abs(sources[:, 0, np.newaxis] % self.height - targets[np.newaxis, :, 0] % self.height)
+        d_row = np.minimum(d_row, self.height - d_row)
+        d_col = np.abs(sources[:, 1, np.newaxis] % self.width - targets[np.newaxis, :, 1] % self.width)
+        d_col = np.minimum(d_col, self.width - d_col)
+        return d_row, d_col
+
+    def manhattan_distances(self, sources, targets):
+        '''Batch version of manhattan_distance(): returns a len(sources) x len(targets) array of grid distances.'''
+        d_row, d_col = self._wrapped_deltas(sources, targets)
+        return d_row + d_col
+
+    def euclidean_distances2(self, sources, targets):
+        '''Batch version of euclidean_distance2(): returns a len(sources) x len(targets) array of squared distances.'''
+        d_row, d_col = self._wrapped_deltas(sources, targets)
+        return d_row*d_row + d_col*d_col
+
+    def manhattan_distance_arrays(self, locs1, locs2):
+        '''Elementwise grid distance between two broadcastable arrays of locations, whose last axis is (row, col).'''
+        locs1 = np.asarray(locs1, dtype=int)
+        locs2 = np.asarray(locs2, dtype=int)
+        d_row = np.abs(locs1[..., 0] % self.height - locs2[..., 0] % self.height)
+        d_col = np.abs(locs1[..., 1] % self.width - locs2[..., 1] % self.width)
+        return np.minimum(d_row, self.height - d_row) + np.minimum(d_col, self.width - d_col)
+
+    def next_positions(self, locs, directions):
+        '''Batch version of next_position(): returns a len(locs) x len(directions) x 2 array of next positions.'''
+        locs = np.asarray(locs, dtype=int).reshape(-1, 2)
+        offsets = np.array([AIM[d] for d in directions], dtype=int).reshape(-1, 2)
+        positions = locs[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+        positions[..., 0] %= self.height
+        positions[..., 1] %= self.width
+        return positions
+
     def sort_by_distance(self, loc, targ_list): 
         '''Returns a sorted list (dist, (x,y)) from an initial list of (x,y) positions, sorted in ascending order of distance to this ant.'''
-        dists = [ (self.distance(loc, targ), targ) 
-                            for targ in targ_list ]
+        targ_list = list(targ_list)
+        if not targ_list:
+            return []
+        dists = self.manhattan_distances([loc], targ_list)[0]
+        return [(int(dists[i]), targ_list[i]) for i in np.argsort(dists, kind='mergesort')]
 
-        dists.sort(key=(lambda x: x[0]))
-        return dists
+    def closest_location(self, loc, targ_list, exclude_self=False):
+        '''Get the location in targ_list that is closest to loc, or None if targ_list is empty. If exclude_self is set, loc itself is never returned.'''
+        targ_list = list(targ_list)
+        if not targ_list:
+            return None
+        if len(targ_list) == 1:
+            if exclude_self and targ_list[0] == loc:
+                return None
+            return targ_list[0]
+        dists = self.manhattan_distances([loc], targ_list)[0]
+        if exclude_self:
+            dists[dists == 0] = MAX_INT
+        i = int(np.argmin(dists))
+        if dists[i] == MAX_INT:
+            return None
+        return targ_list[i]
 
     def toward(self, loc, targ):
         """Get the possible directions that move this ant closer to this target. Since ants can't move diagonally, there may be multiple directions."""
@@ -415,34 +633,23 @@ class AntWorld(object):
 
     def closest_food(self, loc):
         '''Get the closest food, or None if no food is in sight.'''
-        dists = self.sort_by_distance(loc, self.food)
-        if dists:
-            return dists[0][1]
-        else:
-            return None
+        return self.closest_location(loc, self.food)
 
     def closest_enemy(self, loc):
         '''Get the closest enemy, or None if no enemy is in sight.'''
-        dists = self.sort_by_distance(loc, self.enemies)
-        if dists:
-            return dists[0][1]
-        else:
-            return None
+        return self.closest_location(loc, self.enemies)
 
     def closest_friend(self, loc):
         """Get the closest friendly ant to this position that is not on this position"""
-        ant_locs = [ant.location for ant in self.ants]
-        dists = self.sort_by_distance(loc, ant_locs)
-        if dists:
-            if dists[0][1] == loc:
-                if len(dists) > 1:
-                    return dists[1][1]
-                else:
-                    return None
-            else:
-                return dists[0][1]
-        else:
-            return None
+        return self.closest_location(loc, [ant.location for ant in self.ants], exclude_self=True)
+
+    def find_path(self, loc, targ):
+        '''Get the shortest path from loc to targ as a list of locations (excluding loc), or None if no path was found this turn. Unseen squares are assumed to be land.'''
+        return self.pathfinder.find_path(loc, targ)
+
+    def path_direction(self, loc, targ):
+        '''Get the first direction along the shortest path from loc to targ, or None.'''
+        return self.pathfinder.path_direction(loc, targ)
 
     def get_passable_direction(self, loc, dirs):
         """Filter a list of NSEW directions to remove directions that are not passable from an ant's current position. Returns the FIRST direction that is passable."""
@@ -465,6 +672,137 @@ class AntWorld(object):
                 passable_dirs.append(d)
         return passable_dirs
 
+    def get_enterable_directions(self, loc, dirs):
+        '''Filter a list of NSEW directions down to those whose destination is enterable(), including squares held by friendly ants that might move away.'''
+        if dirs is None:
+            return None
+        return [d for d in dirs if d is not None and self.enterable(self.next_position(loc, d))]
+
+    def resolve_moves(self, preferences):
+        '''Turn ranked direction preferences into collision-free orders.
+
+        preferences is a list of (ant, dirs) pairs, where dirs lists directions in order of
+        preference; None or 'halt' means stay put. Ants are resolved in the order given. Each
+        ant gets its most preferred direction whose destination is enterable() and not claimed
+        by another friendly ant. A square held by a friendly ant can be entered once that ant
+        has decided to move away, and chains, swaps and rotations of ants moving into each
+        other's squares are resolved together. Ants whose preferences can't be satisfied stay
+        put, as do alive ants that are not listed.
+
+        Sets ant.direction for every listed ant and returns a dict of ant -> direction.
+        '''
+        UNVISITED, IN_PROGRESS, DONE = 0, 1, 2
+
+        ants = [ant for ant, dirs in preferences]
+        prefs = dict((ant, list(dirs) if dirs else []) for ant, dirs in preferences)
+        status = dict((ant, UNVISITED) for ant in ants)
+        pref_index = dict((ant, 0) for ant in ants)
+        stack_pos = {}
+        orders = {}
+
+        # Occupancy hash of our ants' current squares, and squares claimed as destinations.
+        occupant = dict((ant.location, ant) for ant in ants)
+        claimed = set(ant.location for ant in self.ants
+                      if ant.status == AntStatus.ALIVE and ant not in status)
+
+        def commit(ant, direction, dest):
+            status[ant] = DONE
+            orders[ant] = direction
+            claimed.add(dest)
+
+        for first in ants:
+            if status[first] == DONE:
+                continue
+            stack = [first]
+            status[first] = IN_PROGRESS
+            stack_pos[first] = 0
+            while stack:
+                ant = stack[-1]
+                if status[ant] == DONE:
+                    stack.pop()
+                    continue
+
+                # Out of preferences: stay put. Nobody can have claimed our square
+                # unless we had already decided to leave it.
+                if pref_index[ant] >= len(prefs[ant]):
+                    commit(ant, None, ant.location)
+                    stack.pop()
+                    continue
+
+                d = prefs[ant][pref_index[ant]]
+                if d is None or d == 'halt':
+                    commit(ant, None, ant.location)
+                    stack.pop()
+                    continue
+
+                dest = self.next_position(ant.location, d)
+                if dest in claimed or not self.enterable(dest):
+                    pref_index[ant] += 1
+                    continue
+
+                other = occupant.get(dest)
+                if other is None or status[other] == DONE:
+                    # Empty square, or its occupant has already moved away.
+                    commit(ant, d, dest)
+                    stack.pop()
+                elif status[other] == IN_PROGRESS:
+                    # Every ant on the stack from other upwards is trying to move into the
+                    # square of the next one: a swap or rotation. Move them all at once.
+                    for member in stack[stack_pos[other]:]:
+                        member_dir = prefs[member][pref_index[member]]
+                        commit(member, member_dir, self.next_position(member.location, member_dir))
+                else:
+                    # Decide where the occupant goes before deciding whether we can follow.
+                    status[other] = IN_PROGRESS
+                    stack_pos[other] = len(stack)
+                    stack.append(other)
+
+        for ant in ants:
+            ant.direction = orders[ant]
+        return orders
+
+    def assign_moves(self, ants, directions, values, stay_value=None, rng=None):
+        '''Pick collision-free orders for a group of ants that maximize their total value.
+
+        values[i][j] is the value of moving ants[i] in directions[j]; moves worth -inf are
+        never made. Unlike resolve_moves(), which gives each ant in turn its best remaining
+        move, this solves for all ants jointly, so an ant gives way to a neighbour that would
+        lose more than it gains. Moves must be enterable() and may not end on the square of
+        an alive ant that is not in the group. Every ant can also stay put, which is worth
+        stay_value (by default, less than any move, so ants only stay when they have to).
+        Ties are broken randomly if rng (a numpy RandomState) is given.
+
+        Sets ant.direction for every ant and returns a dict of ant -> direction.
+        '''
+        values = np.asarray(values, dtype=float).reshape(len(ants), len(directions))
+        finite = values[np.isfinite(values)]
+        if stay_value is None:
+            stay_value = finite.min() - (finite.max() - finite.min()) - 1.0 if finite.size else 0.0
+
+        group = set(ants)
+        blocked = set(ant.location for ant in self.ants
+                      if ant.status == AntStatus.ALIVE and ant not in group)
+
+        options = []
+        for ant, row in zip(ants, values):
+            moves = [(ant.location, None, stay_value)]
+            for d, value in zip(directions, row):
+                if value == float('-inf'):
+                    continue
+                dest = self.next_position(ant.location, d)
+                if dest not in blocked and self.enterable(dest):
+                    moves.append((dest, d, value))
+            if rng is not None:
+                moves = [moves[k] for k in rng.permutation(len(moves))]
+            options.append(moves)
+
+        choice = auction_assignment([[(dest, value) for dest, d, value in moves] for moves in options])
+
+        orders = {}
+        for ant, moves, k in zip(ants, options, choice):
+            ant.direction = orders[ant] = moves[k][1]
+        return orders
+
     def directions(self, loc1, loc2):
         '''Get directions that move closer to loc2 from loc1.
         
@@ -6,9 +6,18 @@ Created on Oct 1, 2011
 
 from src.batchlocalengine import BatchLocalEngine
 from greedybot import GreedyBot
-from src.features import MovingTowardsFeatures
+from src.cmaes import CMAES
+from src.features import FeatureExtractor, MovingTowardsFeatures
+from src.mappool import MapPool
+from src.results import ResultStore
 from valuebot import ValueBot
+from multiprocessing import Pool
+from optparse import OptionParser
+import numpy as np
+import json
+import os
 import random
+import time
 
 def win_rate(bot_wins, bot_games):
     """ Compute the win % and sort accordingly given # of wins and games.
@@ -23,39 +32,218 @@ def win_rate(bot_wins, bot_games):
     
     return win_rate
 
-if __name__ == '__main__':
+def evaluate_candidate(args):
+    """ Play a ValueBot with the given features and weights against GreedyBot in its own engine.
+    
+    args is a tuple (features_dict, weights, num_games, map_dims, seed, turns, cutoff, results_file, 
+    map_pool), so that this can be used with Pool.map(). cutoff is a (cutoff_turn, cutoff_percent) 
+    pair: games end early once one bot or the food has made up cutoff_percent of all ants and 
+    food for cutoff_turn turns. If results_file is not None, games are recorded in and resumed 
+    from that ResultStore. If map_pool is not None, maps are drawn from that MapPool. 
+    Returns (score, wins, score_diff, games) for the ValueBot.
+    
+    """
+    
+    (features_dict, weights, num_games, map_dims, seed, turns, cutoff, results_file, map_pool) = args
+    
     engine = BatchLocalEngine()
+    engine.PrepareGame(["--run", "-t", str(turns), 
+                        "--cutoff_turn", str(cutoff[0]), "--cutoff_percent", str(cutoff[1])])
+    
+    bot = ValueBot(engine.GetWorld(), load_file=None)
+    bot.set_features(FeatureExtractor(features_dict))
+    bot.set_weights(list(weights))
+    
+    results = None
+    if results_file is not None:
+        results = ResultStore(results_file)
+    
+    (bot_scores, bot_wins, bot_score_diffs, bot_games) = engine.RunTournament(num_games, [bot], [GreedyBot(engine.GetWorld())], 
+                                                                              map_dims, seed=seed, verbose=False, 
+                                                                              results=results, map_pool=map_pool)
+    return (bot_scores[0][0], bot_wins[0][0], bot_score_diffs[0][0], bot_games[0][0])
+
+def default_cutoff_turn(turns):
+    """ Number of dominated turns after which a training game of the given length ends early."""
+    
+    return max(1, turns / 4)
 
-    # Run quick games: 100 turns only
-    engine.PrepareGame(["--run", "-t", "100"])
+def evaluate_population(features, population, num_games, map_dims, seed=None, turns=100, processes=None, 
+                        results_file=None, map_pool=None, cutoff_turn=None, cutoff_percent=0.90):
+    """ Evaluate a population of weight vectors against GreedyBot in parallel.
+    
+    Every candidate plays the same num_games maps with the same engine seeds (common random
+    numbers), so that differences between candidates come from their weights rather than from
+    the maps they happened to draw. If seed is None, a random one is picked. Games are spread 
+    over processes worker processes (default: one per CPU; 1 runs everything in this process).
+    Lopsided games end early (see evaluate_candidate()); cutoff_turn defaults to a quarter of 
+    the game length. If results_file is given, all games are appended to it, and games already in it are not 
+    played again (see results.py). If map_pool is given, the maps are drawn from it (see 
+    mappool.py) rather than generated by every candidate.
+    
+    Returns (bot_scores, bot_wins, bot_score_diffs, bot_games), each a list with one entry per 
+    candidate in population.
+    
+    """
+    
+    if seed is None:
+        seed = random.getrandbits(31)
+    if map_pool is not None:
+        # Generate or load the maps once here, rather than in every worker.
+        map_pool.prepare([map_dims])
+    if cutoff_turn is None:
+        cutoff_turn = default_cutoff_turn(turns)
+    cutoff = (cutoff_turn, cutoff_percent)
+    jobs = [(features.to_dict(), list(weights), num_games, map_dims, seed, turns, cutoff, results_file, map_pool) 
+            for weights in population]
     
-    # Initialize a random set of bots
-    features = MovingTowardsFeatures()
-    team_a = [ValueBot(engine.GetWorld(), load_file=None) for i in range(5)]
-    for bot in team_a:
-        w = [random.uniform(-1,1) for i in range(0, features.num_features())]
-        bot.set_features(features)        
-        bot.set_weights(w)
+    if processes == 1:
+        results = map(evaluate_candidate, jobs)
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(evaluate_candidate, jobs)
+        finally:
+            pool.close()
+            pool.join()
     
-    # Play several games against GreedyBot
-    (bot_scores, bot_wins, bot_score_diffs, bot_games) = engine.RunTournament(5, team_a, [GreedyBot(engine.GetWorld())], [30, 30])
+    return tuple([list(r) for r in zip(*results)])
 
-    # Sort bots by their win rate
-    a_rate = win_rate(bot_wins[0], bot_games[0])
+def fitness(bot_score_diffs, bot_games):
+    """ Fitness of each candidate: its average score differential per game."""
     
-    # Print out tournament results according to win rates 
-    for i, rate in a_rate:
-        print "Bot %d: Win rate = %g " % (i, rate)
-        print team_a[i]
-        team_a[i].save("saved_bots/bot_%d.json" % i)
+    return [float(diff) / float(games) for diff, games in zip(bot_score_diffs, bot_games)]
 
-    # Sort bots by their average score differentials
-    a_diffs = win_rate(bot_score_diffs[0], bot_games[0])
+def save_checkpoint(filename, es, features, seed):
+    """ Save the search distribution, features and game seed so that train() can resume."""
+    
+    fp = file(filename + ".tmp", "w")
+    json.dump({'es': es.to_dict(), 'features': features.to_dict(), 'seed': seed}, fp)
+    fp.close()
+    os.rename(filename + ".tmp", filename)
+    
+def load_checkpoint(filename):
+    """ Load (es, features, seed) saved by save_checkpoint()."""
+    
+    fp = file(filename, "r")
+    data = json.load(fp)
+    fp.close()
+    return (CMAES.from_dict(data['es']), FeatureExtractor(data['features']), data['seed'])
+
+def train(features, generations, num_games, map_dims, turns=100, popsize=None, sigma=0.5, 
+          processes=None, checkpoint=None, seed=None, tolerance=1e-3, results_file=None, map_pool=None,
+          cutoff_turn=None, cutoff_percent=0.90):
+    """ Optimize the weights of a ValueBot against GreedyBot with CMA-ES.
+    
+    Each generation, a population of weight vectors is sampled from the search distribution 
+    and evaluated in parallel with evaluate_population(), on maps shared by the whole 
+    generation. The distribution is then updated towards the candidates with the best average 
+    score differential. Models with more than 100 weights use a diagonal covariance. 
+    
+    If checkpoint is given, the search is saved there after every generation, and resumed 
+    from it if it already exists. Training stops after the given total number of generations, 
+    or once the search distribution has converged to within tolerance. If results_file is
+    given, games are recorded there, so that a generation that was interrupted part way
+    through only has to play its missing games when resumed. If map_pool is given, each 
+    generation draws its maps from it, starting at a different position of the pool. Lopsided 
+    games end early after cutoff_turn turns (see evaluate_population()).
+    
+    Returns (es, features), where es is the CMAES object; its mean is the recommended weight 
+    vector. features are the ones given, or the ones in the checkpoint if resuming.
+    
+    """
+    
+    if checkpoint is not None and os.path.exists(checkpoint):
+        (es, features, seed) = load_checkpoint(checkpoint)
+        print "Resuming from %s at generation %d" % (checkpoint, es.generation)
+    else:
+        if seed is None:
+            seed = random.getrandbits(31)
+        n = features.num_features()
+        es = CMAES(np.zeros(n), sigma, popsize, diagonal=n > 100, seed=seed)
+    
+    start_time = time.time()
+    total_games = 0
+    while es.generation < generations and not es.converged(tolerance):
+        gen_start = time.time()
+        population = es.ask()
+        
+        # Games of each generation are seeded differently, but the same for every candidate.
+        (bot_scores, bot_wins, bot_score_diffs, bot_games) = evaluate_population(features, population, num_games, map_dims, 
+                                                                                 seed=seed + es.generation, turns=turns, 
+                                                                                 processes=processes, results_file=results_file,
+                                                                                 map_pool=map_pool, cutoff_turn=cutoff_turn, 
+                                                                                 cutoff_percent=cutoff_percent)
+        f = fitness(bot_score_diffs, bot_games)
+        es.tell(population, f)
+        
+        games = sum(bot_games)
+        total_games += games
+        elapsed = time.time() - gen_start
+        print "Generation %d: %d games in %.1f s (%.2f games/s), fitness best %.2f mean %.2f, best so far %.2f, spread %.4f" % \
+            (es.generation, games, elapsed, games / elapsed, max(f), sum(f) / len(f), es.best_fitness, es.spread())
+        
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, es, features, seed)
+
+    if es.converged(tolerance):
+        print "Converged after %d generations" % es.generation
+    elapsed = time.time() - start_time
+    if total_games > 0:
+        print "Played %d games in %.1f s (%.2f games/s)" % (total_games, elapsed, total_games / elapsed)
+    return (es, features)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("-g", "--generations", dest="generations", default=20, type="int",
+                      help="Total number of generations to train for")
+    parser.add_option("-n", "--games", dest="games", default=5, type="int",
+                      help="Number of games per candidate and generation")
+    parser.add_option("-p", "--popsize", dest="popsize", default=None, type="int",
+                      help="Number of candidates per generation (default: 4 + 3 ln(# weights))")
+    parser.add_option("-s", "--sigma", dest="sigma", default=0.5, type="float",
+                      help="Initial step size of the search")
+    parser.add_option("-j", "--processes", dest="processes", default=None, type="int",
+                      help="Number of worker processes (default: one per CPU)")
+    parser.add_option("-t", "--turns", dest="turns", default=100, type="int",
+                      help="Number of turns per game")
+    parser.add_option("--cutoff_turn", dest="cutoff_turn", default=None, type="int",
+                      help="End a game once one bot or the food has dominated for this many turns " +
+                      "(default: a quarter of the turns)")
+    parser.add_option("--cutoff_percent", dest="cutoff_percent", default=0.90, type="float",
+                      help="Fraction of all ants and food that counts as dominating")
+    parser.add_option("--min_dim", dest="min_dim", default=30, type="int",
+                      help="Minimum map dimension")
+    parser.add_option("--max_dim", dest="max_dim", default=30, type="int",
+                      help="Maximum map dimension")
+    parser.add_option("--seed", dest="seed", default=None, type="int",
+                      help="Seed for the search and the games")
+    parser.add_option("--checkpoint", dest="checkpoint", default="saved_bots/cmaes.json",
+                      help="Checkpoint file to save to and resume from")
+    parser.add_option("--results", dest="results", default=None,
+                      help="File to record game results in and resume them from")
+    parser.add_option("--pool_size", dest="pool_size", default=0, type="int",
+                      help="Number of maps in the map pool (default: generate a new map for every game)")
+    parser.add_option("--pool_dir", dest="pool_dir", default="maps/pool",
+                      help="Directory to cache the map pool in")
+    parser.add_option("--pool_vectorized", dest="pool_vectorized", default=False, action="store_true",
+                      help="Generate the map pool with the numpy map generator")
+    parser.add_option("-o", "--output", dest="output", default="saved_bots/cmaes_bot.json",
+                      help="File to save the trained bot to")
+    (opts, args) = parser.parse_args()
+    
+    map_pool = None
+    if opts.pool_size > 0:
+        map_pool = MapPool(opts.pool_dir, opts.pool_size, processes=opts.processes, vectorized=opts.pool_vectorized)
     
-    # Print out tournament results according to score differentials
-    for i, diff in a_diffs:
-        print "Bot %d: Score diff = %g " % (i, diff)
-        print team_a[i]
-        team_a[i].save("saved_bots/bot_%d.json" % i)
+    (es, features) = train(MovingTowardsFeatures(), opts.generations, opts.games, [opts.min_dim, opts.max_dim], 
+               turns=opts.turns, popsize=opts.popsize, sigma=opts.sigma, processes=opts.processes, 
+               checkpoint=opts.checkpoint, seed=opts.seed, results_file=opts.results, map_pool=map_pool,
+               cutoff_turn=opts.cutoff_turn, cutoff_percent=opts.cutoff_percent)
     
-    
\ No newline at end of file
+    # Save the mean of the search distribution, which is less noisy than the best single candidate.
+    bot = ValueBot(BatchLocalEngine().GetWorld(), load_file=None)
+    bot.set_features(features)
+    bot.set_weights(es.mean.tolist())
+    print bot
+    bot.save(opts.output)
@@ -2,24 +2,37 @@
 # Created: October 2011
 # Author: David Weiss
 import random
-import json
 import os.path
 
-from src.antsbot import AntsBot
+import numpy as np
+
+from src.antsbot import AntsBot, TurnDeadline
 from src.worldstate import AIM, AntStatus
 from src.mapgen import SymmetricMap
-from src.features import FeatureExtractor, MovingTowardsFeatures
+from src.features import MovingTowardsFeatures
+from src.modelfile import load_model, model_file, save_model, save_json_model
 from src.state import GlobalState
+
+# Actions evaluated for each ant, in the column order of the value matrix.
+ACTIONS = ['n', 'e', 's', 'w']
                
 class ValueBot(AntsBot):
     """ Value function based AntsBot.
 
     This is a template class that uses a FeatureExtractor and a set of weights to make decisions
-    based on a weighted sum of features (value function.) It is capable of loading and saving to JSON using
-    the FeatureExtractor.to_dict() method and FeatureExtractor(input_dict) constructor.
+    based on a weighted sum of features (value function.) It is capable of loading and saving to file using
+    the FeatureExtractor.to_dict() method and FeatureExtractor(input_dict) constructor, either as JSON or in
+    the binary format of modelfile.py.
+    
+    Each turn, all ants and actions are scored in one batch with FeatureExtractor.score_batch(), which
+    is a matrix-vector product against the weight vector that skips extractors whose weights are all zero.
+    The moves are then chosen jointly with AntWorld.assign_moves(), so that ants don't collide.
       
     """
     
+    # Number of ants to evaluate between deadline checks.
+    batch_size = 64
+    
     def __init__(self, world, load_file="valuebot.json"):
         """Initialize, optionally loading from file. 
         
@@ -32,26 +45,25 @@ class ValueBot(AntsBot):
         self.state = None
         self.features = None
         self.weights = None
+        self.weight_vector = None
         
         # **** NOTE: Disable ant tracking to speed up game playing. 
         self.world.stateless = True
         
-        # Try to load saved configuration from file
-        if load_file is not None and os.path.exists(load_file):
-            fp = file(load_file, "r")
-            data = json.load(fp)
-            self.set_features(FeatureExtractor(data['features']))
-            self.set_weights(data['weights'])
-            fp.close()
+        # Try to load saved configuration from file (binary or JSON, see modelfile.py)
+        if load_file is not None and model_file(load_file) is not None:
+            features, weights = load_model(load_file)
+            self.set_features(features)
+            self.set_weights(weights)
     
     def save(self, filename):
-        """Save features and weights to file."""
+        """Save features and weights to file. Files ending in .json are saved as JSON, and all others 
+        in the binary format."""
         
-        fp = file(filename, "w")
-        data = {'features': self.features.to_dict(), 
-                'weights': self.weights }
-        json.dump(data, fp)
-        fp.close()
+        if os.path.splitext(filename)[1] == '.json':
+            save_json_model(filename, self.features, self.weights)
+        else:
+            save_model(filename, self.features, self.weights)
             
     def __str__(self):
         """Print a labeled list of weight values."""
@@ -70,53 +82,78 @@ class ValueBot(AntsBot):
         """Set weight vector. Note: checks that len(weights) == self.features.num_features()."""                    
                 
         self.weights = weights
-        self.world.L.debug("Setting weights: %s" % str(self.weights))
+        # Floating point arrays, e.g. the memory-mapped weights of a binary model, are used without copying.
+        self.weight_vector = np.asarray(weights)
+        if self.weight_vector.dtype.kind != 'f':
+            self.weight_vector = self.weight_vector.astype(float)
+        if self.world.debug_mode:
+            self.world.L.debug("Setting weights: %s" % str(self.weights))
         if self.features == None or not len(self.weights) == self.features.num_features():
             raise AssertionError("Features need to be set before weights!")
 
     def value(self, state, loc, action):
         """Compute the value of a given action w.r.t. a given state and ant location."""
         
-        feature_vector = self.features.extract(self.world, state, loc, action)
+        dot_product = self.features.score(self.world, state, loc, action, self.weight_vector)
         
-        self.world.L.info("Evaluating move: %s, %s:" % (str(loc), action))
-        dot_product = 0
-        for i in range(0, len(feature_vector)):
-            if feature_vector[i]:
+        if self.world.debug_mode:
+            self.world.L.info("Evaluating move: %s, %s:" % (str(loc), action))
+            for i in self.features.active_features(self.world, state, loc, action):
                 self.world.L.info("\tf: %s = %g" % (self.features.feature_name(i), self.weights[i]))
-                dot_product += self.weights[i]
-        self.world.L.info("\tdot_product = %g" % dot_product)
+            self.world.L.info("\tdot_product = %g" % dot_product)
         
         return dot_product
              
-    def get_direction(self, ant):
-        """Evaluates each of the currently passable directions and picks the one with maximum value."""
+    def rank_directions(self, ant):
+        """Evaluates each of the currently enterable directions and ranks them by decreasing value.
+        
+        This and get_direction() evaluate a single ant, for callers outside do_turn(), which uses
+        value_matrix() and AntWorld.assign_moves() instead.
+        """
         
-        # get the passable directions, in random order to break ties
-        rand_dirs = self.world.get_passable_directions(ant.location, AIM.keys())
+        # get the enterable directions, in random order to break ties
+        rand_dirs = self.world.get_enterable_directions(ant.location, [d for d in AIM.keys() if d != 'halt'])
         random.shuffle(rand_dirs)
         
         # evaluate the value function for each possible direction
-        value = [0 for i in range(0, len(rand_dirs))]
-        max_value = float("-inf")
-        max_dir = None
-        for i in range(0, len(rand_dirs)):
-            value[i] = self.value(self.state, ant.location, rand_dirs[i])
-            if value[i] > max_value:
-                max_value = value[i]
-                max_dir = rand_dirs[i]
-                
-        # take direction with maximum value
-        # Get the first passable direction from that long list.
-        self.world.L.info("Chose: %s, value: %.2f" % (max_dir, max_value))
-        return max_dir
+        value = {}
+        for d in rand_dirs:
+            value[d] = self.value(self.state, ant.location, d)
+        
+        # sort is stable, so ties stay in random order
+        rand_dirs.sort(key=lambda d: value[d], reverse=True)
+        if rand_dirs and self.world.debug_mode:
+            self.world.L.info("Ranked: %s, best value: %.2f" % (str(rand_dirs), value[rand_dirs[0]]))
+        return rand_dirs
+             
+    def get_direction(self, ant):
+        """Evaluates each of the currently enterable directions and picks the one with maximum value."""
+        
+        ranked = self.rank_directions(ant)
+        if ranked:
+            return ranked[0]
+        return None
+
+    def value_matrix(self, locs):
+        """Compute the values of all ACTIONS for all locations as a len(locs) x len(ACTIONS) array.
+        
+        Actions into squares that can't be entered get a value of -inf.
+        """
+        
+        values = self.features.score_batch(self.world, self.state, locs, ACTIONS, self.weight_vector)
+        
+        enterable = np.array([[self.world.enterable(self.world.next_position(loc, d)) for d in ACTIONS] 
+                              for loc in locs], dtype=bool).reshape(values.shape)
+        values[~enterable] = float('-inf')
+        return values
 
     # Main logic
     def do_turn(self):
-        """Precomputes global state, and then chooses max value action for each ant independently."""
+        """Precomputes global state, computes the values of all actions for all ants in batches, and 
+        then picks the collision-free combination of moves with the highest total value.
         
-        # Run the routine for each living ant independently.
-        next_locations = {}
+        If the turn runs out of time, the ants that were not yet evaluated stay put.
+        """
         
         # Grid lookup resolution: size 10 squares
         if self.state == None:
@@ -124,18 +161,28 @@ class ValueBot(AntsBot):
         else:
             self.state.update()
         
-        for ant in self.world.ants:
-            if ant.status == AntStatus.ALIVE:
-                ant.direction = self.get_direction(ant)
-                if ant.direction == 'halt' or ant.direction == None:
-                    ant.direction = None
-                else:
-                    # Basic collision detection: don't land on the same square as another friendly ant.
-                    nextpos = self.world.next_position(ant.location, ant.direction) 
-                    if nextpos in next_locations.keys():  
-                        ant.direction = None
-                    else:
-                        next_locations[nextpos] = ant.ant_id
+        # Tie breaking draws from the global random stream, so games stay reproducible from the player seed.
+        rng = np.random.RandomState(random.getrandbits(32))
+        
+        ants = [ant for ant in self.world.ants if ant.status == AntStatus.ALIVE]
+        evaluated = []
+        values = []
+        try:
+            for start in range(0, len(ants), self.batch_size):
+                self.checkpoint()
+                batch = ants[start:start+self.batch_size]
+                batch_values = self.value_matrix([ant.location for ant in batch])
+                evaluated.extend(batch)
+                values.append(batch_values)
+                
+                if self.world.debug_mode:
+                    for ant, row in zip(batch, batch_values):
+                        self.world.L.info("%s: values %s" % (str(ant.location), str(row)))
+        except TurnDeadline:
+            self.world.L.warning("Out of time after evaluating %d ants" % len(evaluated))
+        
+        if evaluated:
+            self.world.assign_moves(evaluated, ACTIONS, np.vstack(values), rng=rng)
 
     def reset(self):
         self.state = None